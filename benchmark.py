@@ -0,0 +1,190 @@
+"""Benchmarks of the TCSA pipeline stages.
+
+Usage:
+    python benchmark.py parse <perf_script.txt> [--jobs 1 2 4 8]
+    python benchmark.py cicp [--sizes 1000000 10000000 50000000] [--legacy-max 1000000]
+    python benchmark.py timeline [--sizes 1000 10000 100000] [--legacy-max 10000]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from joblib import cpu_count
+
+from filtering import (
+    identify_consecutive_identical_call_stacks,
+    identify_consecutive_identical_call_stacks_parallel,
+    identify_consecutive_identical_call_stacks_vectorized,
+)
+from modeling import TimingGraph
+from timing import DataPreparation
+
+SYNTHETIC_FRAMES = [
+    "7b124bd2f21d __GI___clone3+0x2c (/usr/lib/x86_64-linux-gnu/libc.so.6)",
+    "7b124bc94ac3 start_thread+0x2d1 (/usr/lib/x86_64-linux-gnu/libc.so.6)",
+    "5d4c3a1b2210 waiter_thread_main+0x3d (/root/mock/contender)",
+    "5d4c3a1b21e2 wait_for_lock+0x12 (/root/mock/contender)",
+    "5d4c3a1b21b9 check_and_acquire_lock+0xf (/root/mock/contender)",
+    "5d4c3a1b21bc check_and_acquire_lock+0x12 (/root/mock/contender)",
+    "ffffffffabc01b2b asm_sysvec_apic_timer_interrupt+0x1b ([kernel.kallsyms])",
+    "ffffffffad12a477 sysvec_apic_timer_interrupt+0x47 ([kernel.kallsyms])",
+    "ffffffffabf5b67b native_apic_msr_eoi+0xb ([kernel.kallsyms])",
+]
+
+
+def _timed(func, *args, **kwargs):
+    start_time = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start_time, result
+
+
+def bench_parse(args: argparse.Namespace) -> None:
+    """Scaling of the chunk-parallel perf script parser with the number of processes."""
+    size = os.path.getsize(args.file_path) / 1024 / 1024
+    print(f"file: {args.file_path} ({size:.1f} MiB), cores: {cpu_count()}")
+
+    baseline, perf_records_df = _timed(
+        DataPreparation().data_loading, args.file_path
+    )
+    print(f"data_loading: {baseline:.2f}s, {len(perf_records_df)} samples")
+
+    jobs_list = args.jobs
+    if not jobs_list:
+        jobs_list = [1]
+        while jobs_list[-1] * 2 <= cpu_count():
+            jobs_list.append(jobs_list[-1] * 2)
+    single = None
+    for n_jobs in jobs_list:
+        elapsed, _ = _timed(
+            DataPreparation().data_loading_parallel, args.file_path, n_jobs=n_jobs
+        )
+        single = single or elapsed
+        print(
+            f"data_loading_parallel n_jobs={n_jobs}: {elapsed:.2f}s, "
+            f"{size / elapsed:.1f} MiB/s, speedup x{single / elapsed:.2f}"
+        )
+
+
+def synthetic_samples(
+    sample_count: int, thread_count: int = 64, seed: int = 0
+) -> tuple:
+    """Samples in the layout of data_processing, modelled on mock/contender.c.
+
+    At each of its samples a thread draws a new call stack with probability 0.1.
+
+    :return: (data_preparation, perf_records_df)
+    """
+    rng = np.random.default_rng(seed)
+    data_preparation = DataPreparation()
+    stack_table = data_preparation.stack_table
+    stacks = [
+        SYNTHETIC_FRAMES[:4] + [SYNTHETIC_FRAMES[4]],
+        SYNTHETIC_FRAMES[:4] + [SYNTHETIC_FRAMES[5]],
+        SYNTHETIC_FRAMES[:4] + [SYNTHETIC_FRAMES[5]] + SYNTHETIC_FRAMES[6:],
+        SYNTHETIC_FRAMES[:3],
+    ]
+    for stack in stacks:
+        stack_table.intern_lines(stack)
+
+    tids = rng.integers(0, thread_count, sample_count)
+    changes = rng.random(sample_count) < 0.1
+    stack_ids = np.empty(sample_count, dtype=np.int32)
+    order = np.argsort(tids, kind="stable")
+    run_id = np.cumsum(changes[order])
+    stack_ids[order] = rng.integers(0, len(stacks), run_id[-1] + 1)[run_id]
+
+    perf_records_df = pd.DataFrame(
+        {
+            "timestamp": 5736.0 + np.arange(sample_count) * 1e-4,
+            "command": np.full(sample_count, "contender", dtype=object),
+            "tid": tids + 9000,
+            "cpu": rng.integers(0, 8, sample_count),
+            "event": np.full(sample_count, "1001001", dtype=object),
+            "stack_id": stack_ids,
+        }
+    )
+    return data_preparation, data_preparation.data_processing(perf_records_df)
+
+
+def bench_cicp(args: argparse.Namespace) -> None:
+    """CICP identification: vectorized vs the shared-memory parallel and serial paths."""
+    implementations = [
+        ("vectorized", identify_consecutive_identical_call_stacks_vectorized, None),
+        ("parallel", identify_consecutive_identical_call_stacks_parallel, None),
+        ("serial", identify_consecutive_identical_call_stacks, args.legacy_max),
+    ]
+    for sample_count in args.sizes:
+        _, perf_records_df = synthetic_samples(sample_count, args.threads)
+        for name, func, max_size in implementations:
+            if max_size is not None and sample_count > max_size:
+                print(f"{sample_count:>10} samples {name:>10}: skipped (--legacy-max)")
+                continue
+            elapsed, records_df = _timed(func, perf_records_df.copy(), -1, 0)
+            print(
+                f"{sample_count:>10} samples {name:>10}: {elapsed:8.2f}s, "
+                f"{len(records_df)} CICPs"
+            )
+
+
+def bench_timeline(args: argparse.Namespace) -> None:
+    """Render time of the thread timing graph: vectorized PolyCollection vs one broken_barh per CICP."""
+    implementations = [
+        ("vectorized", "gen_thread_timing_event_graph_vectorized", None),
+        ("broken_barh", "gen_thread_timing_event_graph", args.legacy_max),
+    ]
+    for cicp_count in args.sizes:
+        # about 10 samples per CICP, see synthetic_samples
+        _, perf_records_df = synthetic_samples(cicp_count * 10, args.threads)
+        records_df = identify_consecutive_identical_call_stacks_vectorized(
+            perf_records_df, -1, 0
+        ).iloc[:cicp_count]
+        for name, method, max_size in implementations:
+            if max_size is not None and cicp_count > max_size:
+                print(f"{cicp_count:>10} CICPs {name:>11}: skipped (--legacy-max)")
+                continue
+            with tempfile.TemporaryDirectory() as output_path:
+                timing_graph = TimingGraph(output_path, "bench")
+                elapsed, _ = _timed(getattr(timing_graph, method), records_df)
+            print(f"{cicp_count:>10} CICPs {name:>11}: {elapsed:8.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="stage", required=True)
+
+    parse_parser = subparsers.add_parser("parse", help=bench_parse.__doc__)
+    parse_parser.add_argument("file_path")
+    parse_parser.add_argument("--jobs", type=int, nargs="*")
+    parse_parser.set_defaults(func=bench_parse)
+
+    cicp_parser = subparsers.add_parser("cicp", help=bench_cicp.__doc__)
+    cicp_parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1000000, 10000000, 50000000]
+    )
+    cicp_parser.add_argument("--threads", type=int, default=64)
+    cicp_parser.add_argument(
+        "--legacy-max",
+        type=int,
+        default=1000000,
+        help="Largest sample count run through the serial path.",
+    )
+    cicp_parser.set_defaults(func=bench_cicp)
+
+    timeline_parser = subparsers.add_parser("timeline", help=bench_timeline.__doc__)
+    timeline_parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1000, 10000, 100000]
+    )
+    timeline_parser.add_argument("--threads", type=int, default=64)
+    timeline_parser.add_argument(
+        "--legacy-max",
+        type=int,
+        default=10000,
+        help="Largest CICP count drawn with one broken_barh per CICP.",
+    )
+    timeline_parser.set_defaults(func=bench_timeline)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,5 +1,19 @@
+import hashlib
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+import numpy as np
 import pandas as pd
-from joblib import Parallel, delayed
+from joblib import Parallel, cpu_count, delayed
+
+from stacks import FrameNormalizer, StackTrie, kernel_address_mask, object_array
+from trace_format import TraceFile
+
+# Columns derived from the call stack, identical for every sample of a CICP.
+STACK_COLUMNS = ["stack_id", "top_function", "execution_mode"]
 
 
 def divide_TOCC_optimized(df: pd.DataFrame) -> list:
@@ -72,37 +86,182 @@ def divide_TOCC_optimized(df: pd.DataFrame) -> list:
     return tocc_list
 
 
-def _process_single_thread_cics(thread_df: pd.DataFrame) -> pd.DataFrame:
-    """处理单个线程的DataFrame，识别CICP"""
-    if thread_df.empty:
-        return pd.DataFrame()
+def divide_TOCC_vectorized(df: pd.DataFrame) -> np.ndarray:
+    """
+    [向量化版] 扫描线划分 TOCC，不再构造 Python 事件元组，也不再为每个 TOCC 复制 DataFrame。
 
-    compare_key = thread_df["user_defined_indentical_call_stacks"]
-    thread_df["token"] = (compare_key != compare_key.shift()).cumsum()
+    1. 把 ts_begin / ts_end 拼接成一个事件数组 (开始 +1，结束 -1) 并 argsort；
+       同一时刻结束事件排在开始事件之前 (首尾相接的区间不算重叠，与 divide_TOCC_optimized 相同)，
+       只有 ts_begin == ts_end 的区间的结束事件排在开始事件之后；
+    2. cumsum 得到每个事件之后的活跃 CICP 数，活跃数回到 0 的位置就是一个重叠窗口的结束；
+    3. 只保留包含一个以上 CICP 的窗口，按 CICP 数从多到少编号。
 
-    # 聚合，找出CICP
-    processed_df = thread_df.groupby(["token"], as_index=False).aggregate(
-        lambda x: list(x)
+    :param df: 一个包含所有CICP事件的DataFrame，必须包含 'ts_begin' 和 'ts_end' 列。
+    :return: 与 df 的行一一对应的 tocc_id 数组 (int64)，0 是最大的 TOCC，-1 表示不属于任何 TOCC。
+    """
+    length = len(df)
+    tocc_id = np.full(length, -1, dtype=np.int64)
+    if length == 0:
+        return tocc_id
+
+    ts_begin = df["ts_begin"].to_numpy(dtype=np.float64)
+    ts_end = df["ts_end"].to_numpy(dtype=np.float64)
+    times = np.concatenate([ts_begin, ts_end])
+    # 同一时刻的排序: 结束 (0) < 开始 (1) < 零长度区间的结束 (2)
+    kinds = np.concatenate(
+        [np.ones(length, dtype=np.int8), np.where(ts_end > ts_begin, 0, 2).astype(np.int8)]
+    )
+    deltas = np.concatenate(
+        [np.ones(length, dtype=np.int64), np.full(length, -1, dtype=np.int64)]
     )
+    order = np.lexsort((kinds, times))
+    active = np.cumsum(deltas[order])
+
+    window_start = np.empty(2 * length, dtype=bool)
+    window_start[0] = True
+    window_start[1:] = active[:-1] == 0
+    event_window = np.cumsum(window_start) - 1
+    is_begin = order < length
+    window = np.empty(length, dtype=np.int64)
+    window[order[is_begin]] = event_window[is_begin]
+
+    # 按窗口内的 CICP 数从多到少排序 (稳定排序，数量相同时先出现的窗口在前)。
+    # 只含一个 CICP 的窗口排在最后，因此保留下来的窗口编号是连续的 0..k-1。
+    sizes = np.bincount(window)
+    rank = np.empty_like(sizes)
+    rank[np.argsort(-sizes, kind="stable")] = np.arange(len(sizes))
+    keep = sizes[window] > 1
+    tocc_id[keep] = rank[window[keep]]
+    return tocc_id
+
+
+def _as_perf_records_df(
+    perf_records, kernel_boundary="auto", normalizer: FrameNormalizer = None
+) -> pd.DataFrame:
+    """Accept the output of DataPreparation.data_processing or a TraceFile (.tcsa) directly.
 
-    # 清理和格式化结果
-    processed_df["duration_length"] = processed_df[
-        "user_defined_indentical_call_stacks"
-    ].apply(lambda x: len(x))
-    processed_df["tid"] = processed_df["tid"].apply(lambda x: x[0])
-    processed_df["command"] = processed_df["command"].apply(lambda x: x[0])
-    processed_df["event"] = processed_df["event"].apply(lambda x: x[0])
-    processed_df["ts_begin"] = processed_df["timestamp"].apply(lambda x: x[0])
-    processed_df["ts_end"] = processed_df["timestamp"].apply(lambda x: x[-1])
-    processed_df["user_defined_indentical_call_stacks"] = processed_df[
-        "user_defined_indentical_call_stacks"
-    ].apply(lambda x: x[0])
-    processed_df["function_call_stack"] = processed_df["function_call_stack"].apply(
-        lambda x: x[0]
+    :param kernel_boundary: used to tell kernel mode from user mode for a TraceFile,
+        see stacks.kernel_address_mask.
+    :param normalizer: the derived columns of a TraceFile describe the stacks folded by it.
+    """
+    if isinstance(perf_records, TraceFile):
+        from timing import DataPreparation  # timing imports this module
+
+        data_preparation = DataPreparation(
+            kernel_boundary=kernel_boundary, normalizer=normalizer
+        )
+        data_preparation.stack_table = perf_records.stack_table()
+        return data_preparation.data_processing(perf_records.samples())
+    return perf_records
+
+
+class _SharedArrays:
+    """把 NumPy 数组写入内存映射文件 (优先放在 /dev/shm)，工作进程按路径映射，不需要 pickle 数据本身。"""
+
+    def __init__(self, arrays: dict) -> None:
+        self.directory = tempfile.mkdtemp(
+            prefix="tcsa-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None
+        )
+        self.spec = {}
+        for name, array in arrays.items():
+            path = os.path.join(self.directory, name)
+            shared = np.memmap(path, dtype=array.dtype, mode="w+", shape=array.shape)
+            shared[:] = array
+            shared.flush()
+            self.spec[name] = (path, array.dtype.str, array.shape)
+
+    def __enter__(self) -> "_SharedArrays":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _attach_shared_arrays(spec: dict) -> dict:
+    return {
+        name: np.memmap(path, dtype=np.dtype(dtype), mode="r", shape=shape)
+        for name, (path, dtype, shape) in spec.items()
+    }
+
+
+def _run_begins(tids: np.ndarray, key_ids: np.ndarray, begin: int, end: int) -> np.ndarray:
+    """在按 (tid, timestamp) 排好序的数组的 [begin, end) 区间内找出每个 CICP 的起始下标。"""
+    tids = tids[begin:end]
+    key_ids = key_ids[begin:end]
+    change = np.ones(len(tids), dtype=bool)
+    change[1:] = (tids[1:] != tids[:-1]) | (key_ids[1:] != key_ids[:-1])
+    return np.flatnonzero(change) + begin
+
+
+def _shared_run_begins(spec: dict, begin: int, end: int) -> np.ndarray:
+    """工作进程：只接收共享数组的路径和 (begin, end)，返回紧凑的 int64 起始下标数组。"""
+    arrays = _attach_shared_arrays(spec)
+    return _run_begins(arrays["tid"], arrays["key_id"], begin, end)
+
+
+def _split_ranges(length: int, parts: int) -> list:
+    """把 [0, length) 切分为 parts 个长度相近的时间片 (切分点可以落在同一个线程内部)。"""
+    cuts = np.unique(np.arange(parts + 1) * length // max(parts, 1)).tolist()
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+def _stitch_run_begins(
+    tids: np.ndarray, key_ids: np.ndarray, ranges: list, begin_list: list
+) -> np.ndarray:
+    """拼接各个时间片的 CICP 起始下标。
+
+    每个时间片的第一个样本总会被当作一个 CICP 的开始，如果它与上一个时间片的最后一个样本
+    属于同一个线程且调用栈 key 相同，说明这个 CICP 跨越了切分点，去掉这个起始下标即可把两段合并。
+    """
+    stitched = list(begin_list)
+    for i, (begin, _) in enumerate(ranges[1:], start=1):
+        if tids[begin] == tids[begin - 1] and key_ids[begin] == key_ids[begin - 1]:
+            stitched[i] = stitched[i][1:]
+    return np.concatenate(stitched) if stitched else np.array([], dtype=np.int64)
+
+
+def _sorted_cicp_keys(
+    perf_records_df: pd.DataFrame,
+    degrees_of_freedom: int,
+    direction: int,
+    tries: dict = None,
+    normalizer: FrameNormalizer = None,
+) -> tuple:
+    """计算每个样本的调用栈 key id，并按 (tid, timestamp) 排序。
+
+    :return: (order, 排序后的 tid 数组, 排序后的 key id 数组)
+    """
+    key_ids = set_user_defined_indentical_call_stacks(
+        perf_records_df, degrees_of_freedom, direction, tries, normalizer
     )
-    processed_df["call_stack"] = processed_df["call_stack"].apply(lambda x: x[0])
+    tids = perf_records_df["tid"].to_numpy()
+    timestamps = perf_records_df["timestamp"].to_numpy(dtype=np.float64)
+    order = np.lexsort((timestamps, tids))
+    return order, tids[order], np.asarray(key_ids)[order]
 
-    return processed_df
+
+def _cicp_table(
+    perf_records_df: pd.DataFrame, order: np.ndarray, begin_index: np.ndarray
+) -> pd.DataFrame:
+    """由排序后每个 CICP 的起始下标构建 CICP 表，其他列取每段第一个样本的值。"""
+    columns = [
+        column
+        for column in ["tid", "command", "event", "call_stack", "function_call_stack"]
+        + ["user_defined_indentical_call_stacks"]
+        + STACK_COLUMNS
+        if column in perf_records_df.columns
+    ]
+    end_index = np.empty_like(begin_index)
+    end_index[:-1] = begin_index[1:] - 1
+    end_index[-1:] = len(order) - 1
+
+    timestamps = perf_records_df["timestamp"].to_numpy(dtype=np.float64)
+    first_rows = order[begin_index]
+    records_df = perf_records_df[columns].iloc[first_rows].reset_index(drop=True)
+    records_df["ts_begin"] = timestamps[first_rows]
+    records_df["ts_end"] = timestamps[order[end_index]]
+    records_df["duration_length"] = end_index - begin_index + 1
+    return records_df
 
 
 def identify_consecutive_identical_call_stacks_parallel(
@@ -110,62 +269,94 @@ def identify_consecutive_identical_call_stacks_parallel(
     degrees_of_freedom: int,
     direction: int,
     n_jobs: int = -1,
+    normalizer: FrameNormalizer = None,
+    kernel_boundary="auto",
 ) -> pd.DataFrame:
     """
     并行化版本的CICP识别函数。
 
+    排序后的 tid / key id 数组放在共享的内存映射文件中，工作进程只接收 (begin, end) 区间，
+    返回每个 CICP 起始下标组成的 int64 数组，
+    不再把每个线程的 DataFrame (以及 call_stack 列表、字符串列) pickle 给工作进程。
+    joblib 的 loky 后端会在多次调用之间复用同一个进程池。
+
+    区间按样本数均匀切分，不要求落在线程边界上，因此即使样本集中在一两个繁忙的线程中也能用满所有核心；
+    跨越切分点的 CICP 由 _stitch_run_begins 合并，结果与串行版本完全相同。
+
+    :param perf_records_df: data_processing 的输出，或者一个 TraceFile。
     :param n_jobs: 使用的CPU核心数，-1代表使用所有核心。
+    :param normalizer: 帧名规范化 (stacks.FrameNormalizer)。
+    :param kernel_boundary: 输入为 TraceFile 时区分内核态 / 用户态的边界，见 stacks.kernel_address_mask。
     """
-    # 准备工作
-    column_name = "call_stack"
-    perf_records_df["user_defined_indentical_call_stacks"] = perf_records_df[
-        column_name
-    ].apply(
-        lambda x: get_user_defined_indentical_call_stacks(
-            x, degrees_of_freedom, direction
-        )
+    perf_records_df = _as_perf_records_df(perf_records_df, kernel_boundary, normalizer)
+    order, tids, key_ids = _sorted_cicp_keys(
+        perf_records_df, degrees_of_freedom, direction, normalizer=normalizer
     )
-    perf_records_df["top_function"] = perf_records_df[
-        "user_defined_indentical_call_stacks"
-    ].apply(lambda x: x.split(";")[-1])
+    n_jobs = cpu_count() if n_jobs == -1 else max(1, n_jobs)
+    ranges = _split_ranges(len(order), n_jobs)
 
-    # 将DataFrame按线程ID拆分成一个列表
-    thread_groups = [group for name, group in perf_records_df.groupby("tid")]
+    if n_jobs == 1 or len(ranges) <= 1:
+        begin_list = [_run_begins(tids, key_ids, begin, end) for begin, end in ranges]
+    else:
+        with _SharedArrays({"tid": tids, "key_id": key_ids}) as shared:
+            begin_list = Parallel(n_jobs=n_jobs)(
+                delayed(_shared_run_begins)(shared.spec, begin, end)
+                for begin, end in ranges
+            )
+    begin_index = _stitch_run_begins(tids, key_ids, ranges, begin_list)
+    return _cicp_table(perf_records_df, order, begin_index)
 
-    # 使用joblib并行处理每个线程的DataFrame
-    # delayed()将函数调用包装成一个可并行执行的任务
-    results_list = Parallel(n_jobs=n_jobs)(
-        delayed(_process_single_thread_cics)(group) for group in thread_groups
-    )
 
-    # 将并行处理的结果合并成一个最终的DataFrame
-    records_df = pd.concat(results_list)
-    return records_df
+def identify_consecutive_identical_call_stacks_vectorized(
+    perf_records_df: pd.DataFrame,
+    degrees_of_freedom: int,
+    direction: int,
+    tries: dict = None,
+    normalizer: FrameNormalizer = None,
+    kernel_boundary="auto",
+) -> pd.DataFrame:
+    """
+    [向量化版] 一次性识别所有线程的 CICP，不再按线程拆分、也不再把每一列聚合成列表。
+
+    1. 按 (tid, timestamp) 排序一次；
+    2. 相邻样本的 tid 或调用栈 key id 不同的位置就是一个 CICP 的开始 (变化点掩码)；
+    3. 由每段的首/尾下标直接得到 ts_begin、ts_end 和 duration_length，其他列取每段第一个样本的值。
+
+    :param perf_records_df: data_processing 的输出，或者一个 TraceFile。
+    :param degrees_of_freedom: 识别连续相同调用栈时使用的层数，-1 表示整个调用栈。
+    :param direction: bottom up 0 / top down 1。
+    :param tries: 见 set_user_defined_indentical_call_stacks。
+    :param normalizer: 帧名规范化 (stacks.FrameNormalizer)。
+    :param kernel_boundary: 输入为 TraceFile 时区分内核态 / 用户态的边界，见 stacks.kernel_address_mask。
+    :return: 以 CICP 为单位的 DataFrame，列与 identify_consecutive_identical_call_stacks 相同 (不含列表列)。
+    """
+    perf_records_df = _as_perf_records_df(perf_records_df, kernel_boundary, normalizer)
+    order, tids, key_ids = _sorted_cicp_keys(
+        perf_records_df, degrees_of_freedom, direction, tries, normalizer
+    )
+    return _cicp_table(perf_records_df, order, _run_begins(tids, key_ids, 0, len(order)))
 
 
 def identify_consecutive_identical_call_stacks(
-    perf_records_df: pd.DataFrame, degrees_of_freedom: int, direction: int
+    perf_records_df: pd.DataFrame,
+    degrees_of_freedom: int,
+    direction: int,
+    kernel_boundary="auto",
 ) -> pd.DataFrame:
     """
 
-    :param perf_records_df: timing call stacks
+    :param perf_records_df: timing call stacks, or a TraceFile
     :param degrees_of_freedom: The number of user-defined call stack layers. For the number of recognized layers of
                                the call stack per thread, -1 means that the entire call stack is recognized.
     :param direction: bottom up 0 / top down 1。
+    :param kernel_boundary: start of the kernel address space used for a TraceFile input.
     :return:
     """
 
-    column_name = "call_stack"
-    perf_records_df["user_defined_indentical_call_stacks"] = perf_records_df[
-        column_name
-    ].apply(
-        lambda x: get_user_defined_indentical_call_stacks(
-            x, degrees_of_freedom, direction
-        )
+    perf_records_df = _as_perf_records_df(perf_records_df, kernel_boundary)
+    set_user_defined_indentical_call_stacks(
+        perf_records_df, degrees_of_freedom, direction
     )
-    perf_records_df["top_function"] = perf_records_df[
-        "user_defined_indentical_call_stacks"
-    ].apply(lambda x: x.split(";")[-1])
 
     threads_list = perf_records_df.tid.unique()
     records_df_list = []
@@ -192,21 +383,92 @@ def identify_consecutive_identical_call_stacks(
             lambda x: x[0]
         )
         thread_df["call_stack"] = thread_df["call_stack"].apply(lambda x: x[0])
+        for column in STACK_COLUMNS:
+            if column in thread_df.columns:
+                thread_df[column] = thread_df[column].apply(lambda x: x[0])
         records_df_list.append(thread_df)
     records_df = pd.concat(records_df_list)
     return records_df
 
 
+def set_user_defined_indentical_call_stacks(
+    perf_records_df: pd.DataFrame,
+    degrees_of_freedom: int,
+    direction: int,
+    tries: dict = None,
+    normalizer: FrameNormalizer = None,
+) -> np.ndarray:
+    """Add the user_defined_indentical_call_stacks and top_function columns.
+
+    When the samples carry a stack_id, a StackTrie is built over the unique call stacks and
+    the key of each unique call stack is the trie node at the requested depth, so only the
+    keys of the reached nodes are joined into strings and broadcast to the samples.
+
+    :param perf_records_df: timing call stacks
+    :param degrees_of_freedom:
+    :param direction: bottom up 0 / top down 1
+    :param tries: optional {direction: StackTrie} cache, only valid for the same perf_records_df
+        and normalizer, so that sweeps over degrees_of_freedom build each trie once.
+    :param normalizer: frame name normalization (stacks.FrameNormalizer), computed once per frame.
+    :return: integer id of the user defined identical call stack of each sample.
+    """
+    if "stack_id" in perf_records_df.columns:
+        _, first_index, inverse = np.unique(
+            perf_records_df["stack_id"].to_numpy(),
+            return_index=True,
+            return_inverse=True,
+        )
+        trie = None if tries is None else tries.get(direction)
+        if trie is None:
+            trie = StackTrie(
+                perf_records_df["call_stack"].to_numpy()[first_index],
+                direction,
+                normalizer,
+            )
+            if tries is not None:
+                tries[direction] = trie
+        node_ids = trie.node_ids(degrees_of_freedom)
+        stack_keys = trie.keys(node_ids)
+        perf_records_df["user_defined_indentical_call_stacks"] = stack_keys[inverse]
+        perf_records_df["top_function"] = object_array(
+            [x.split(";")[-1] for x in stack_keys]
+        )[inverse]
+        key_ids, _ = pd.factorize(stack_keys)
+        return key_ids[inverse]
+
+    column_name = "call_stack"
+    perf_records_df["user_defined_indentical_call_stacks"] = perf_records_df[
+        column_name
+    ].apply(
+        lambda x: get_user_defined_indentical_call_stacks(
+            x, degrees_of_freedom, direction, normalizer
+        )
+    )
+    perf_records_df["top_function"] = perf_records_df[
+        "user_defined_indentical_call_stacks"
+    ].apply(lambda x: x.split(";")[-1])
+    key_ids, _ = pd.factorize(perf_records_df["user_defined_indentical_call_stacks"])
+    return key_ids
+
+
 def get_user_defined_indentical_call_stacks(
-    function_list: list, degrees_of_freedom: int, direction: int
+    function_list: list,
+    degrees_of_freedom: int,
+    direction: int,
+    normalizer: FrameNormalizer = None,
 ) -> str:
     """
 
     :param function_list: a column of dataframs
     :param degrees_of_freedom:
     :param direction: bottom up 0 / top down 1
+    :param normalizer: frame name normalization, the default keeps "symbol+offset (module)".
     :return: string of the function call chain
     """
+    if degrees_of_freedom < -1:
+        raise ValueError(f"invalid degrees_of_freedom {degrees_of_freedom}")
+    if normalizer is not None:
+        function_list = normalizer.stack_labels(function_list)
     original_length = len(function_list)
     length = min(degrees_of_freedom, original_length)
 
@@ -218,11 +480,150 @@ def get_user_defined_indentical_call_stacks(
     if direction == 0:
         function_list = function_list[0:length]
     else:
-        function_list = function_list[(original_length - length) : length]
-    res_function_call = ";".join([" ".join(j.split()[1:]) for j in function_list])
+        # top down keeps the top `length` frames of the stack.
+        function_list = function_list[original_length - length :]
+    if normalizer is not None:
+        return ";".join(function_list)
+    # 与 FrameNormalizer.label 相同，帧名中的分号替换为冒号，使 key 可以按分号拆分为帧
+    res_function_call = ";".join(
+        [" ".join(j.split()[1:]).replace(";", ":") for j in function_list]
+    )
     return res_function_call
 
 
+# Commands whose samples are not of interest (idle task).
+USELESS_COMMANDS = ["swapper"]
+
+
+class SampleFilter:
+    """下推到 perf script 解析器中的样本谓词。
+
+    被排除的样本在解析阶段就被丢弃 (不会解析其调用栈，也不会进入帧字典 / 调用栈字典)，
+    不再在生成 CICP 之后才由 filtering_operation 过滤。字段可以是 str 或者 bytes (并行解析器)。
+
+    * exclude_commands: 命令名包含其中任意一项的样本被丢弃 (与 filtering_operation 相同)；
+    * tids / pids: 只保留这些线程 / 进程的样本 (pid 需要 perf script 输出 "pid/tid"，没有 pid 的样本不匹配，
+      第一次遇到这样的样本时在 stderr 上给出提示；TCSA trace 文件不保存 pid，mask 在设置了 pids 时报错)；
+    * events: 只保留 event 字段等于其中一项的样本；
+    * since / until: 只保留时间戳位于 [since, until] 内的样本；
+    * min_run_length: 融合解析器 (data_loading_cicp) 中，样本数少于该值的 CICP 在游程关闭时直接丢弃。
+    """
+
+    def __init__(
+        self,
+        exclude_commands=(),
+        tids=None,
+        pids=None,
+        events=None,
+        since: float = None,
+        until: float = None,
+        min_run_length: int = 1,
+    ) -> None:
+        self.exclude_commands = tuple(exclude_commands)
+        self.tids = None if tids is None else frozenset(int(x) for x in tids)
+        self.pids = None if pids is None else frozenset(int(x) for x in pids)
+        self.events = None if events is None else frozenset(events)
+        self.since = since
+        self.until = until
+        self.min_run_length = min_run_length
+        self._command_cache = {}
+        self._event_cache = {}
+        self._missing_pid_reported = False
+
+    @property
+    def active(self) -> bool:
+        """是否有样本级别的谓词。"""
+        return bool(
+            self.exclude_commands
+            or self.tids is not None
+            or self.pids is not None
+            or self.events is not None
+            or self.since is not None
+            or self.until is not None
+        )
+
+    def key(self) -> str:
+        """样本级别谓词的规范化表示，用于解析结果缓存的 key。"""
+        return repr(
+            (
+                sorted(self.exclude_commands),
+                None if self.tids is None else sorted(self.tids),
+                None if self.pids is None else sorted(self.pids),
+                None if self.events is None else sorted(self.events),
+                self.since,
+                self.until,
+            )
+        )
+
+    def accepts_command(self, command) -> bool:
+        allowed = self._command_cache.get(command)
+        if allowed is None:
+            text = command.decode("utf-8", "replace") if isinstance(command, bytes) else command
+            allowed = not any(x in text for x in self.exclude_commands)
+            self._command_cache[command] = allowed
+        return allowed
+
+    def accepts_event(self, event) -> bool:
+        if self.events is None:
+            return True
+        allowed = self._event_cache.get(event)
+        if allowed is None:
+            text = event.decode("utf-8", "replace") if isinstance(event, bytes) else event
+            allowed = text in self.events
+            self._event_cache[event] = allowed
+        return allowed
+
+    def accepts(self, timestamp, command, tid, event, pid=None) -> bool:
+        """判断一个样本的事件头是否满足所有谓词。"""
+        if self.tids is not None and int(tid) not in self.tids:
+            return False
+        if self.pids is not None:
+            if pid is None:
+                if not self._missing_pid_reported:
+                    self._missing_pid_reported = True
+                    print(
+                        "warning: --pid is set but the perf script samples have no pid field "
+                        "(record them with perf script -F pid,tid), these samples are dropped",
+                        file=sys.stderr,
+                    )
+                return False
+            if int(pid) not in self.pids:
+                return False
+        if self.since is not None or self.until is not None:
+            timestamp = float(timestamp)
+            if self.since is not None and timestamp < self.since:
+                return False
+            if self.until is not None and timestamp > self.until:
+                return False
+        return self.accepts_command(command) and self.accepts_event(event)
+
+    def mask(self, perf_records_df: pd.DataFrame) -> np.ndarray:
+        """data_loading 格式的样本 (例如 TCSA trace 文件) 上的向量化版本。"""
+        if self.pids is not None:
+            # 样本数组中没有 pid，不能静默地丢弃所有样本
+            raise ValueError(
+                "pid filtering needs perf script text input recorded with -F pid,tid, "
+                "TCSA trace files do not store pids"
+            )
+        keep = np.ones(len(perf_records_df), dtype=bool)
+        if self.tids is not None:
+            keep &= perf_records_df["tid"].isin(self.tids).to_numpy()
+        timestamps = perf_records_df["timestamp"].to_numpy(dtype=np.float64)
+        if self.since is not None:
+            keep &= timestamps >= self.since
+        if self.until is not None:
+            keep &= timestamps <= self.until
+        for column, accepts in (
+            ("command", self.accepts_command),
+            ("event", self.accepts_event),
+        ):
+            codes, values = pd.factorize(perf_records_df[column])
+            allowed = np.array([accepts(str(x)) for x in values], dtype=bool)
+            if len(codes):
+                keep &= allowed[codes]
+        return keep
+
+
 def filtering_operation(df: pd.DataFrame) -> pd.DataFrame:
     """Filter out data from threads where the consecutive identical call stacks do not occur consistently.
         Support presetting of thread IDs/process names that do not care.
@@ -232,8 +633,7 @@ def filtering_operation(df: pd.DataFrame) -> pd.DataFrame:
     """
     threshold_duration_length = 1
     df = df[df.duration_length > threshold_duration_length]
-    useless_command_list = ["swapper"]
-    for command in useless_command_list:
+    for command in USELESS_COMMANDS:
         df = df[df.command.str.contains(command) == False]
     # df = df.sort_values(by=['duration_length', 'ts_begin'], ascending=[False, True])
     return df
@@ -290,6 +690,64 @@ def divide_TOCC(df: pd.DataFrame) -> list:
     return tocc_df_list
 
 
+def _begin_segments(
+    groups: np.ndarray, ts_begin: np.ndarray, ts_end: np.ndarray
+) -> tuple:
+    """在按 (groups, ts_begin) 排好序的数组上，按 divide_TOCC 的语义划分每个分组内的重叠段。
+
+    每个 ts_begin 取值只由第一次出现的那一行扩展区间，闭区间重叠 (首尾相接也算) 的行属于同一段，
+    当某个 ts_begin 大于分组内之前所有 ts_end 的最大值时开始新的一段。
+
+    :return: (每段的起始行, 每段内不同 ts_begin 的个数)
+    """
+    new_group = np.r_[True, groups[1:] != groups[:-1]]
+    first_rows = np.flatnonzero(new_group | np.r_[True, ts_begin[1:] != ts_begin[:-1]])
+    first_groups = groups[first_rows]
+    first_begin = ts_begin[first_rows]
+    reach = pd.Series(ts_end[first_rows]).groupby(first_groups).cummax().to_numpy()
+    segment_first = np.flatnonzero(
+        np.r_[
+            True,
+            (first_groups[1:] != first_groups[:-1]) | (first_begin[1:] > reach[:-1]),
+        ]
+    )
+    sizes = np.diff(np.r_[segment_first, len(first_rows)])
+    return first_rows[segment_first], sizes
+
+
+def divide_TOCC_sweep(df: pd.DataFrame) -> list:
+    """
+    divide_TOCC 的 O(N log N) 版本，结果与 divide_TOCC 完全相同。
+
+    divide_TOCC 的语义：
+    1. 按 ts_begin 排序后，每个 ts_begin 取值只由第一次出现的那一行参与合并 (之后相同 ts_begin 的行被跳过，
+       它们的 ts_end 不会扩展区间)；
+    2. 闭区间重叠 (首尾相接也算) 的行合并为一组，组的结束时间取组内 ts_end 的最大值；
+    3. 只保留包含一个以上不同 ts_begin 的组，组内包含所有 ts_begin 相同的行；
+    4. 按组内不同 ts_begin 的个数从多到少稳定排序。
+
+    排序后每一组都是连续的一段，因此只需要一次 cummax：当某个 ts_begin 大于之前所有 ts_end 的最大值时开始新的一组。
+
+    :param df: 包含 'ts_begin' 和 'ts_end' 列的 DataFrame。
+    :return: 每个元素都是一个TOCC的DataFrame。
+    """
+    df = df.sort_values(by=["ts_begin"])
+    if len(df) < 2:
+        return []
+    row_begins, sizes = _begin_segments(
+        np.zeros(len(df), dtype=np.int8),
+        df["ts_begin"].to_numpy(dtype=np.float64),
+        df["ts_end"].to_numpy(dtype=np.float64),
+    )
+    row_ends = np.r_[row_begins[1:], len(df)]
+    tocc_df_list = []
+    for i in np.argsort(-sizes, kind="stable"):
+        if sizes[i] <= 1:
+            break
+        tocc_df_list.append(df.iloc[row_begins[i] : row_ends[i]])
+    return tocc_df_list
+
+
 def distinguish_execution_mode(df_list: list) -> list:
     """
 
@@ -301,9 +759,10 @@ def distinguish_execution_mode(df_list: list) -> list:
     """
     tocc_df_list = []
     for each_df in df_list:
-        each_df["execution_mode"] = each_df["call_stack"].apply(
-            lambda x: judge_execution_mode(x)
-        )
+        if "execution_mode" not in each_df.columns:
+            each_df["execution_mode"] = each_df["call_stack"].apply(
+                lambda x: judge_execution_mode(x)
+            )
         kernel_tocc_df = each_df[each_df.execution_mode == 0]
         user_tocc_df = each_df[each_df.execution_mode == 1]
         kernel_user_tocc_df_list = [kernel_tocc_df, user_tocc_df]
@@ -311,11 +770,14 @@ def distinguish_execution_mode(df_list: list) -> list:
     return tocc_df_list
 
 
-def judge_execution_mode(call_stack: list) -> int:
+def judge_execution_mode(call_stack: list, kernel_boundary="auto") -> int:
     """Determine the mode of operation of the function executed by the thread.
 
     :param call_stack: call stack
-    :return:
+    :param kernel_boundary: "auto", a preset of stacks.KERNEL_BOUNDARIES or the start address of
+        the kernel address space. "auto" treats 64-bit addresses from 0xffffffff80000000 and
+        32-bit addresses from 0xc0000000 as kernel space.
+    :return: kernel 0, user 1
     """
     top_function = call_stack[-1]
     top_function_list = top_function.split(" ")
@@ -323,44 +785,90 @@ def judge_execution_mode(call_stack: list) -> int:
     # 0 is the function address,
     # 1 is the function name,
     # 2 is the function source code corresponding path
-    function_address = top_function_list[0]
-    execution_mode = 1  # kernel 0, user 1
-
-    # 64bit kernel space: 0xffffffff80000000~0xffffffffffffffff
-    # 64bit user space: 0x0000000000000000~0x00007fffffffffff
-    # 32bit kernel space: 0xc0000000~0xffffffff
-    # 32bit user space: 0x00000000~0xbfffffff
-    # TODO: Remove magic number.
-    function_address_len = len(function_address)
-    if function_address_len > 10:
-        if (
-            function_address >= "ffffffff80000000"
-            and function_address <= "ffffffffffffffff"
-        ):
-            execution_mode = 0
-    else:
-        if function_address >= "c0000000" and function_address <= "xffffffff":
-            execution_mode = 0
+    # The address is compared as a number, perf does not pad addresses to a fixed width.
+    try:
+        function_address = int(top_function_list[0], 16)
+    except ValueError:
+        return 1
+    return 0 if kernel_address_mask([function_address], kernel_boundary)[0] else 1
+
+
+def parse_degrees_of_freedom(value: str) -> int:
+    """解析 degrees_of_freedom 参数 (--sweep 的深度也用它)：非负整数，或者 -1 表示整个调用栈。"""
+    depth = int(value)
+    if depth < -1:
+        raise ValueError(
+            f"invalid degrees_of_freedom {depth}, expected -1 (whole call stack) or a depth >= 0"
+        )
+    return depth
+
+
+def parse_threshold(value: str):
+    """解析 duration_length 阈值参数。
+
+    :param value: 整数 (绝对阈值，-1 表示每组的平均值)、mean、median、pXX (每组的 XX 百分位数，例如 p90)
+                  或 topK (每组只保留 duration_length 最大的 K 个 CICP，例如 top5，相同时保留靠前的行)。
+    :return: int 或者规范化后的字符串。
+    """
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    value = value.strip().lower()
+    if value in ("mean", "median") or re.fullmatch(r"top[1-9]\d*", value):
+        return value
+    if re.fullmatch(r"p\d+(\.\d+)?", value) and float(value[1:]) <= 100:
+        return value
+    raise ValueError(
+        f"invalid threshold {value!r}, expected an integer, mean, median, pXX or topK"
+    )
+
 
-    return execution_mode
+def pruning_mask(
+    duration_length: np.ndarray, groups: np.ndarray, duration_length_threshold=-1
+) -> np.ndarray:
+    """
+    [向量化版] 一次 groupby 计算所有组的阈值，每组的阈值只由本组的 CICP 决定。
+
+    :param duration_length: 每个 CICP 的 duration_length。
+    :param groups: 每个 CICP 所在的组 (例如 TOCC 和执行模式的组合)。
+    :param duration_length_threshold: 见 parse_threshold。
+    :return: 保留的 CICP 的布尔数组。
+    """
+    durations = pd.Series(np.asarray(duration_length))
+    grouped = durations.groupby(np.asarray(groups))
+    threshold = duration_length_threshold
+    if isinstance(threshold, str) and threshold.startswith("top"):
+        ranks = grouped.rank(method="first", ascending=False)
+        return (ranks <= int(threshold[3:])).to_numpy()
+    if threshold == -1 or threshold == "mean":
+        thresholds = grouped.transform("mean")
+    elif threshold == "median":
+        thresholds = grouped.transform("median")
+    elif isinstance(threshold, str) and threshold.startswith("p"):
+        thresholds = grouped.transform("quantile", float(threshold[1:]) / 100)
+    else:
+        thresholds = threshold
+    return (durations >= thresholds).to_numpy()
 
 
 def pruning_by_threshold(df_list: list, duration_length_threshold: int) -> list:
     """Implementation of filter pruning, mainly for the setting and implementation of custom thresholds
 
     :param df_list:
-    :param threshold:
+    :param duration_length_threshold: see parse_threshold, -1 means the mean value of each DataFrame.
     :return:
         example：
         [df_1, df_2, df_3, ...]
     """
     res_df_list = []
     for each_df in df_list:
-        if duration_length_threshold == -1:
-            tid_num = len(each_df)
-            duration_length_sum = each_df["duration_length"].sum()
-            duration_length_threshold = duration_length_sum / tid_num
-        tmp_df = each_df[each_df.duration_length >= duration_length_threshold]
+        keep = pruning_mask(
+            each_df["duration_length"].to_numpy(),
+            np.zeros(len(each_df), dtype=np.int8),
+            duration_length_threshold,
+        )
+        tmp_df = each_df[keep]
         res_df_list.append(tmp_df)
     return res_df_list
 
@@ -405,7 +913,7 @@ def divide_each_subTOCC(df_list: list) -> list:
     """
     each_subTOCC_df_list = []
     for each_df in df_list:
-        tmp_subTOCC_df_list = divide_TOCC(each_df)  # redivide
+        tmp_subTOCC_df_list = divide_TOCC_sweep(each_df)  # redivide
         each_subTOCC_df_list += tmp_subTOCC_df_list
 
     # NOTE: We believe that the more threads in a DataFrame, the more likely there is competition and therefore prioritize display.
@@ -431,3 +939,213 @@ def divide_subTOCC(df_list: list) -> list:
         tmp_subTOCC_df_list = divide_each_subTOCC(each_df_list)
         subTOCC_df_list.append(tmp_subTOCC_df_list)
     return subTOCC_df_list
+
+
+def build_cicp_table(
+    df: pd.DataFrame, duration_length_threshold: int = -1
+) -> pd.DataFrame:
+    """
+    [主 CICP 表] 用一张表代替 divide_TOCC_optimized -> distinguish_execution_mode
+    -> duration_threshold_setting -> divide_subTOCC 之间传递的嵌套 DataFrame 列表。
+
+    在 filtering_operation 的输出上增加两列 (execution_mode 列就是内核态 0 / 用户态 1)：
+    * tocc_id: divide_TOCC_vectorized 的结果，-1 表示不属于任何 TOCC；
+    * subtocc_id: 每个 TOCC 按执行模式拆开、按阈值剪枝后再按 divide_TOCC 的语义划分出的子 TOCC，
+      编号顺序与 divide_subTOCC 展开后的顺序相同 (先内核态后用户态)，-1 表示被剪枝或不属于任何子 TOCC。
+
+    整个过程只复制一次表，子 TOCC 的行由 subtocc_views 按需取出。
+
+    :param df: filtering_operation 的输出。
+    :param duration_length_threshold: 见 parse_threshold，每个 TOCC 的每种执行模式独立计算阈值 (pruning_mask)。
+    :return: 增加了 tocc_id、subtocc_id 列的 CICP 表 (行顺序和索引不变)。
+    """
+    tocc_id = divide_TOCC_vectorized(df)
+    table = df.assign(tocc_id=tocc_id, subtocc_id=np.int64(-1))
+    if "execution_mode" not in table.columns:
+        table["execution_mode"] = table["call_stack"].apply(judge_execution_mode)
+    if len(table) == 0:
+        return table
+
+    mode = table["execution_mode"].to_numpy(dtype=np.int64)
+    duration_length = table["duration_length"].to_numpy()
+    ts_begin = table["ts_begin"].to_numpy(dtype=np.float64)
+    ts_end = table["ts_end"].to_numpy(dtype=np.float64)
+    groups = tocc_id * 2 + mode
+    order = np.lexsort((np.arange(len(table)), ts_begin, groups))
+    order = order[tocc_id[order] >= 0]
+    order = order[
+        pruning_mask(duration_length[order], groups[order], duration_length_threshold)
+    ]
+    if len(order) == 0:
+        return table
+    row_begins, sizes = _begin_segments(groups[order], ts_begin[order], ts_end[order])
+    row_counts = np.diff(np.r_[row_begins, len(order)])
+
+    # divide_subTOCC 的顺序: 每种模式内，按 TOCC 顺序拼接各 TOCC 内按不同 ts_begin 数稳定排序的子 TOCC，
+    # 再按行数稳定排序
+    segment_tocc = tocc_id[order[row_begins]]
+    segment_mode = mode[order[row_begins]]
+    ranked = np.lexsort(
+        (np.arange(len(sizes)), -sizes, segment_tocc, -row_counts, segment_mode)
+    )
+    ranked = ranked[sizes[ranked] > 1]
+    segment_subtocc = np.full(len(sizes), -1, dtype=np.int64)
+    segment_subtocc[ranked] = np.arange(len(ranked))
+    subtocc_id = np.full(len(table), -1, dtype=np.int64)
+    subtocc_id[order] = np.repeat(segment_subtocc, row_counts)
+    table["subtocc_id"] = subtocc_id
+    return table
+
+
+class TOCCView:
+    """主 CICP 表中的一个 TOCC / 子 TOCC，只保存行位置，调用 frame() 时才取出对应的行。"""
+
+    def __init__(self, table: pd.DataFrame, rows: np.ndarray) -> None:
+        self.table = table
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @property
+    def execution_mode(self) -> int:
+        """kernel 0, user 1 (TOCC 同时包含两种模式时为 -1)。"""
+        modes = np.unique(self.table["execution_mode"].to_numpy()[self.rows])
+        return int(modes[0]) if len(modes) == 1 else -1
+
+    def frame(self) -> pd.DataFrame:
+        """按 ts_begin 排序的行。"""
+        return self.table.iloc[self.rows]
+
+
+def _table_views(table: pd.DataFrame, id_column: str) -> list:
+    ids = table[id_column].to_numpy()
+    ts_begin = table["ts_begin"].to_numpy(dtype=np.float64)
+    order = np.lexsort((np.arange(len(table)), ts_begin, ids))
+    order = order[ids[order] >= 0]
+    boundaries = np.flatnonzero(np.diff(ids[order])) + 1
+    return [TOCCView(table, rows) for rows in np.split(order, boundaries) if len(rows)]
+
+
+def tocc_views(table: pd.DataFrame) -> list:
+    """build_cicp_table 的表中每个 TOCC 的视图，顺序与 divide_TOCC_optimized 的结果相同。"""
+    return _table_views(table, "tocc_id")
+
+
+def subtocc_views(table: pd.DataFrame) -> list:
+    """build_cicp_table 的表中每个子 TOCC 的视图，顺序与 divide_subTOCC 的结果展开后相同。"""
+    return _table_views(table, "subtocc_id")
+
+
+def thread_count_bucket(thread_count: int) -> int:
+    """线程数的分桶：1、2~3、4~7、8~15 ... 个线程分别为 0、1、2、3 ..."""
+    return int(thread_count).bit_length() - 1
+
+
+def group_signatures(views: list) -> list:
+    """
+    每个竞争组 (TOCCView) 的签名：组内调用栈 key (已按 direction / degrees_of_freedom / 规范化处理)
+    去重排序后的哈希、执行模式和线程数分桶的 SHA-1。同一种竞争模式反复出现时 (例如每次锁交接)，
+    各次出现的签名相同。
+
+    :param views: 同一张 CICP 表的 TOCCView 列表
+    :return: 与 views 一一对应的十六进制签名
+    """
+    if not views:
+        return []
+    table = views[0].table
+    key_hashes = pd.util.hash_array(
+        table["user_defined_indentical_call_stacks"].to_numpy(dtype=object)
+    )
+    tids = table["tid"].to_numpy()
+    signatures = []
+    for view in views:
+        signature = hashlib.sha1(np.unique(key_hashes[view.rows]).tobytes())
+        bucket = thread_count_bucket(len(np.unique(tids[view.rows])))
+        signature.update(f":{view.execution_mode}:{bucket}".encode())
+        signatures.append(signature.hexdigest())
+    return signatures
+
+
+def dedup_views(views: list) -> list:
+    """
+    按 group_signatures 合并重复出现的竞争组。
+
+    :param views: 同一张 CICP 表的 TOCCView 列表
+    :return: [[签名相同的 TOCCView, ...], ...]，按每种签名第一次出现的顺序，组内保持原顺序
+    """
+    groups = {}
+    for view, signature in zip(views, group_signatures(views)):
+        groups.setdefault(signature, []).append(view)
+    return list(groups.values())
+
+
+def occurrence_spans(views: list) -> pd.DataFrame:
+    """
+    合并后的竞争组每次出现的时间范围。
+
+    :param views: 签名相同的 TOCCView 列表
+    :return: 每次出现一行：tocc_id、subtocc_id、ts_begin、ts_end、duration、cicps
+    """
+    rows = []
+    for view in views:
+        table = view.table
+        ts_begin = table["ts_begin"].to_numpy()[view.rows]
+        ts_end = table["ts_end"].to_numpy()[view.rows]
+        rows.append(
+            {
+                "tocc_id": int(table["tocc_id"].to_numpy()[view.rows[0]]),
+                "subtocc_id": int(table["subtocc_id"].to_numpy()[view.rows[0]]),
+                "ts_begin": float(ts_begin.min()),
+                "ts_end": float(ts_end.max()),
+                "duration": float(ts_end.max() - ts_begin.min()),
+                "cicps": len(view),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def sweep_cicp_settings(
+    perf_records_df: pd.DataFrame,
+    directions=(0, 1),
+    depths=(-1,),
+    duration_length_threshold=-1,
+    normalizer: FrameNormalizer = None,
+) -> pd.DataFrame:
+    """
+    对一组 (direction, degrees_of_freedom) 参数分别识别 CICP 并划分竞争组，比较每组参数得到的结果。
+    每个方向的 StackTrie 只构建一次，不同深度只需要在前缀树上重新查询节点。
+
+    :param perf_records_df: data_processing 的输出。
+    :param directions: bottom up 0 / top down 1。
+    :param depths: degrees_of_freedom 的取值，-1 表示整个调用栈。
+    :param duration_length_threshold: 见 parse_threshold。
+    :param normalizer: 帧名规范化 (stacks.FrameNormalizer)。
+    :return: 每组参数一行：CICP 数、TOCC 数、子 TOCC 数，以及最大的子 TOCC 的 CICP 数、线程数和最常见的栈顶函数。
+    """
+    tries = {}
+    rows = []
+    for direction in directions:
+        for degrees_of_freedom in depths:
+            records_df = identify_consecutive_identical_call_stacks_vectorized(
+                perf_records_df, degrees_of_freedom, direction, tries, normalizer
+            )
+            records_df = filtering_operation(records_df)
+            cicp_table = build_cicp_table(records_df, duration_length_threshold)
+            subtocc_list = subtocc_views(cicp_table)
+            largest = subtocc_list[0].frame() if subtocc_list else cicp_table.iloc[:0]
+            rows.append(
+                {
+                    "direction": direction,
+                    "degrees_of_freedom": degrees_of_freedom,
+                    "cicps": len(records_df),
+                    "toccs": int(cicp_table["tocc_id"].max() + 1) if len(cicp_table) else 0,
+                    "subtoccs": len(subtocc_list),
+                    "largest_subtocc_cicps": len(largest),
+                    "largest_subtocc_threads": largest["tid"].nunique(),
+                    "largest_subtocc_top_function": (
+                        largest["top_function"].mode().iat[0] if len(largest) else ""
+                    ),
+                }
+            )
+    return pd.DataFrame(rows)
@@ -1,68 +1,228 @@
+import argparse
 import os
 import sys
 import time
 import warnings
 
+import pandas as pd
 from joblib import Parallel, delayed
 
 from filtering import (
-    distinguish_execution_mode,
-    divide_TOCC,
-    divide_subTOCC,
-    duration_threshold_setting,
+    USELESS_COMMANDS,
+    SampleFilter,
+    build_cicp_table,
+    dedup_views,
     filtering_operation,
-    identify_consecutive_identical_call_stacks_parallel,
-    divide_TOCC_optimized,
+    group_signatures,
+    identify_consecutive_identical_call_stacks_vectorized,
+    occurrence_spans,
+    parse_degrees_of_freedom,
+    parse_threshold,
+    subtocc_views,
+    sweep_cicp_settings,
+)
+from modeling import (
+    TIMELINE_MAX_PIXELS,
+    TimingGraph,
+    call_chains_dot,
+    output_folded_stacks,
+    output_result_summary,
+    render_call_chains,
+)
+from results_store import RESULTS_FILE, write_results, write_text_file
+from stacks import (
+    INTERRUPT_FRAME_PATTERN,
+    KERNEL_BOUNDARIES,
+    NORMALIZATION_MODES,
+    FrameNormalizer,
+    parse_kernel_boundary,
 )
-from modeling import TimingGraph, gen_call_chains, output_result_file
 from timing import DataPreparation
+from trace_cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE, TraceCache
+from trace_export import write_trace_events
+from trace_format import is_trace_file
 
 warnings.filterwarnings("ignore")
 
 
-def input_argv() -> str:
+def input_argv() -> argparse.Namespace:
     """Handling the input parameters.
 
     :return:
     """
-    try:
-        perf_file_path = sys.argv[1]
-    except Exception as e:
-        print(e)
-    try:
-        output_path = sys.argv[2]
-    except Exception as e:
-        print(e)
-    try:
-        direction = int(sys.argv[3])
-    except:
-        direction = 0  # 0 represents a bottom-up call stack, and 1 represents a top-down call stack.
-    try:
-        degrees_of_freedom = int(sys.argv[4])
-    except:
-        degrees_of_freedom = (
-            -1
-        )  # -1 indicates that the entire call stack of the thread is matched.
-    try:
-        threshold = int(sys.argv[5])
-    except:
-        threshold = -1  # Set the threshold for the duration, with the default -1 indicating the use of the mean value.
-    return perf_file_path, output_path, direction, degrees_of_freedom, threshold
-
-
-def _generate_report_for_tocc(output_path, file_name, df):
-    """封装单个TOCC的报告和图像生成任务"""
+    parser = argparse.ArgumentParser(
+        description="TCSA: localization of busy-wait synchronization bugs."
+    )
+    parser.add_argument(
+        "file_path",
+        help="The path of the collected function call stack data "
+        "(perf script text or TCSA trace file).",
+    )
+    parser.add_argument("output_path", help="The path to store the output results.")
+    # 0 represents a bottom-up call stack, and 1 represents a top-down call stack.
+    parser.add_argument("direction", nargs="?", type=int, default=0)
+    # -1 indicates that the entire call stack of the thread is matched.
+    parser.add_argument(
+        "degrees_of_freedom", nargs="?", type=parse_degrees_of_freedom, default=-1
+    )
+    # Set the threshold for the duration, with the default -1 indicating the use of the mean value.
+    # mean / median / pXX (percentile) / topK are computed independently for each TOCC.
+    parser.add_argument("threshold", nargs="?", type=parse_threshold, default=-1)
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="Run-length encode consecutive identical call stacks while parsing, "
+        "without building the per-sample DataFrame.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=-1,
+        help="Number of processes used to parse the perf script file, -1 uses all cores.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=DEFAULT_CACHE_DIR,
+        help="Directory of the parsed trace cache.",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_CACHE_SIZE // 1024 // 1024,
+        help="Size cap of the parsed trace cache in MiB, least recently used entries are evicted.",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Do not use the parsed trace cache."
+    )
+    parser.add_argument(
+        "--exclude-command",
+        action="append",
+        default=[],
+        help="Drop samples whose command contains this string while parsing "
+        f"(in addition to {', '.join(USELESS_COMMANDS)}), can be repeated.",
+    )
+    parser.add_argument(
+        "--tid", type=int, nargs="+", help="Only keep samples of these threads."
+    )
+    parser.add_argument(
+        "--pid",
+        type=int,
+        nargs="+",
+        help="Only keep samples of these processes (needs perf script -F pid,tid).",
+    )
+    parser.add_argument(
+        "--event", nargs="+", help="Only keep samples whose event field is one of these."
+    )
+    parser.add_argument(
+        "--since", type=float, help="Drop samples before this perf timestamp (seconds)."
+    )
+    parser.add_argument(
+        "--until", type=float, help="Drop samples after this perf timestamp (seconds)."
+    )
+    parser.add_argument(
+        "--normalize",
+        choices=NORMALIZATION_MODES,
+        default="none",
+        help="Frame name normalization used to compare call stacks: keep symbol+offset "
+        "(none), strip offsets (offset), function name only (function) or module only (module).",
+    )
+    parser.add_argument(
+        "--fold-interrupts",
+        action="store_true",
+        help="Fold interrupt entry frames (asm_sysvec_*, asm_common_interrupt, ...) and the "
+        "frames above them, so interrupted samples keep the call stack key of the code they interrupted.",
+    )
+    parser.add_argument(
+        "--fold-pattern",
+        help="Regular expression of the function names to fold, implies --fold-interrupts.",
+    )
+    parser.add_argument(
+        "--sweep",
+        type=parse_degrees_of_freedom,
+        nargs="+",
+        metavar="DEPTH",
+        help="Instead of generating reports, evaluate both directions with each of these "
+        "degrees_of_freedom and write a summary of the contention groups to sweep.csv.",
+    )
+    parser.add_argument(
+        "--kernel-boundary",
+        type=parse_kernel_boundary,
+        default="auto",
+        help="Start of the kernel address space used to tell kernel mode from user mode: "
+        f"auto, {', '.join(KERNEL_BOUNDARIES)} or a hexadecimal address.",
+    )
+    parser.add_argument(
+        "--timeline-pixels",
+        type=int,
+        default=TIMELINE_MAX_PIXELS,
+        help="Pixel budget of a thread timing graph, larger groups are drawn with threads "
+        "aggregated into lanes and CICPs binned into per-pixel occupancy.",
+    )
+    parser.add_argument(
+        "--flamegraph",
+        action="store_true",
+        help="Also render the folded stacks of each contention group as an SVG flame graph.",
+    )
+    parser.add_argument(
+        "--no-call-chains",
+        action="store_true",
+        help="Do not generate the gprof2dot/Graphviz call chain graphs.",
+    )
+    parser.add_argument(
+        "--trace-events",
+        action="store_true",
+        help="Write all CICPs to trace_events.json (Chrome Trace Event Format), "
+        "to be browsed in chrome://tracing or the Perfetto UI.",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Collapse contention groups with the same signature (set of call stack keys, "
+        "execution mode and thread count bucket) into one report listing every occurrence.",
+    )
+    args = parser.parse_args()
+    if args.pid is not None and is_trace_file(args.file_path):
+        parser.error(
+            "--pid needs perf script text input recorded with -F pid,tid, "
+            "TCSA trace files do not store pids"
+        )
+    return args
+
+
+def _generate_report_for_tocc(
+    output_path,
+    file_name,
+    df,
+    max_pixels=TIMELINE_MAX_PIXELS,
+    flamegraph=False,
+    call_chains=True,
+    spans=None,
+    normalizer=None,
+):
+    """封装单个TOCC的报告和图像生成任务。
+    调用链图的 DOT 文本和结果摘要返回给主进程，由主进程统一渲染和写出。
+    合并重复出现的竞争组时，df 为第一次出现的那一组，spans 为各次出现的时间范围。
+    """
     print(f"开始为 {file_name} 生成结果...")
-    TimingGraph(output_path, file_name).gen_thread_timing_event_graph(df)
-    output_result_file(output_path, file_name, df)
-    gen_call_chains(output_path, file_name, df)
+    TimingGraph(output_path, file_name).gen_thread_timing_event_graph_vectorized(
+        df, max_pixels
+    )
+    res_lines, group, stacks_df, spans_df = output_result_summary(
+        output_path, file_name, df, spans
+    )
+    output_folded_stacks(output_path, file_name, df, normalizer, flamegraph)
+    dot_source = call_chains_dot(df) if call_chains else None
     print(f"完成 {file_name} 的结果生成。")
+    return file_name, dot_source, res_lines, group, stacks_df, spans_df
 
 
 if __name__ == "__main__":
-    input_file_path, output_file_path, direction, degrees_of_freedom, threshold = (
-        input_argv()
-    )
+    args = input_argv()
+    input_file_path = args.file_path
+    output_file_path = args.output_path
+    direction = args.direction
+    degrees_of_freedom = args.degrees_of_freedom
+    threshold = args.threshold
 
     # The following parameters can be used for testing convenience.
     # -- test begin
@@ -77,25 +237,74 @@ if __name__ == "__main__":
         os.makedirs(output_file_path)
 
     start_time = time.time()
-    raw_data = DataPreparation().data_loading(input_file_path=input_file_path)
-    timing_call_stacks_data = DataPreparation().data_processing(raw_data)
-
-    end_time_2 = time.time()
-    records_df = identify_consecutive_identical_call_stacks_parallel(
-        timing_call_stacks_data, degrees_of_freedom, direction
+    # The predicates of filtering_operation are pushed down into the parser,
+    # excluded samples are never interned or run-length encoded.
+    sample_filter = SampleFilter(
+        exclude_commands=USELESS_COMMANDS + args.exclude_command,
+        tids=args.tid,
+        pids=args.pid,
+        events=args.event,
+        since=args.since,
+        until=args.until,
+        min_run_length=2,
     )
+    fold_pattern = args.fold_pattern
+    if fold_pattern is None and args.fold_interrupts:
+        fold_pattern = INTERRUPT_FRAME_PATTERN
+    normalizer = FrameNormalizer(args.normalize, fold_pattern)
+    # With a fold pattern, the mode and displayed stack of a CICP come from the folded stack.
+    data_preparation = DataPreparation(
+        kernel_boundary=args.kernel_boundary,
+        sample_filter=sample_filter,
+        normalizer=normalizer,
+    )
+    if args.fused and not args.sweep:
+        # Parsing and CICP identification are done in a single pass.
+        records_df = data_preparation.data_loading_cicp(
+            input_file_path, degrees_of_freedom, direction, normalizer
+        )
+        end_time_2 = time.time()
+    else:
+        cache = None
+        timing_call_stacks_data = None
+        if not args.no_cache and not is_trace_file(input_file_path):
+            cache = TraceCache(args.cache_dir, args.cache_size * 1024 * 1024)
+            timing_call_stacks_data = cache.load(input_file_path, data_preparation)
+        if timing_call_stacks_data is None:
+            raw_data = data_preparation.data_loading_parallel(
+                input_file_path=input_file_path, n_jobs=args.jobs
+            )
+            timing_call_stacks_data = data_preparation.data_processing(raw_data)
+            if cache is not None:
+                cache.store(input_file_path, data_preparation, timing_call_stacks_data)
+
+        end_time_2 = time.time()
+        if args.sweep:
+            # Compare the contention groups of every (direction, degrees_of_freedom) setting.
+            sweep_df = sweep_cicp_settings(
+                timing_call_stacks_data, (0, 1), args.sweep, threshold, normalizer
+            )
+            sweep_df.to_csv(os.path.join(output_file_path, "sweep.csv"), index=False)
+            print(sweep_df.to_string(index=False))
+            sys.exit(0)
+        records_df = identify_consecutive_identical_call_stacks_vectorized(
+            timing_call_stacks_data, degrees_of_freedom, direction, normalizer=normalizer
+        )
     records_df = filtering_operation(records_df)
-    tocc_df_list = divide_TOCC_optimized(records_df)
-    tocc_df_list = distinguish_execution_mode(tocc_df_list)
-    tocc_df_list_pruning = duration_threshold_setting(tocc_df_list, threshold)
-    subTocc_df_list = divide_subTOCC(tocc_df_list_pruning)
-    # example:
-    # [ [subTOCC_kernel_1,subTOCC_kernel_2,...]
-    #   [subTOCC_user_1,subTOCC_user_2,...] ]
+    # One CICP table with tocc_id / execution_mode / subtocc_id columns,
+    # each sub-TOCC is only materialized when its report is generated.
+    cicp_table = build_cicp_table(records_df, threshold)
+    subtocc_list = subtocc_views(cicp_table)
+    # --dedup: 签名相同的竞争组只生成一份报告，报告中列出每次出现的时间范围。
+    view_groups = (
+        dedup_views(subtocc_list) if args.dedup else [[view] for view in subtocc_list]
+    )
+    if args.trace_events:
+        write_trace_events(os.path.join(output_file_path, "trace_events.json"), cicp_table)
 
     end_time_3 = time.time()
     # print("Time：" + str(end_time_8 - start_time))
-    perf_records_df_length = len(timing_call_stacks_data)
+    # perf_records_df_length = len(timing_call_stacks_data)
     # print("Size of data volume：" + str(perf_records_df_length))
     # print("Time taken to load/process data:" + str(end_time_2 - start_time))
     print(
@@ -103,16 +312,42 @@ if __name__ == "__main__":
         + str(end_time_3 - end_time_2)
     )
 
-    file_name_pre = "res_"
-    tasks = []
-    num = 1
-    for each_df_list in subTocc_df_list:
-        for each_df in each_df_list:
-            file_name = f"res_{num}"
-            # 将每个任务的参数打包成一个元组
-            tasks.append((output_file_path, file_name, each_df))
-            num += 1
-
     # 并行执行所有报告生成任务
     # n_jobs=-1 代表使用所有可用的CPU核心
-    Parallel(n_jobs=-1)(delayed(_generate_report_for_tocc)(*task) for task in tasks)
+    reports = Parallel(n_jobs=-1)(
+        delayed(_generate_report_for_tocc)(
+            output_file_path,
+            f"res_{num}",
+            views[0].frame(),
+            args.timeline_pixels,
+            args.flamegraph,
+            not args.no_call_chains,
+            occurrence_spans(views) if args.dedup else None,
+            normalizer,
+        )
+        for num, views in enumerate(view_groups, start=1)
+    )
+    # 汇总文件 res 和结果库 results.sqlite 只由主进程按组的顺序写一次。
+    write_text_file(
+        os.path.join(output_file_path, "res"),
+        [line for report in reports for line in report[2]],
+    )
+    groups_df = pd.DataFrame([report[3] for report in reports])
+    if reports:
+        groups_df["signature"] = group_signatures([views[0] for views in view_groups])
+    write_results(
+        os.path.join(output_file_path, RESULTS_FILE),
+        groups_df,
+        pd.concat([report[4] for report in reports], ignore_index=True)
+        if reports
+        else pd.DataFrame(),
+        pd.concat([report[5] for report in reports], ignore_index=True)
+        if reports
+        else pd.DataFrame(),
+    )
+    # 调用链图在所有报告完成后统一渲染，dot 进程数不超过 CPU 核数，
+    # DOT 文本的哈希已有 SVG 的组直接复用。
+    if not args.no_call_chains:
+        render_call_chains(
+            output_file_path, {report[0]: report[1] for report in reports}
+        )
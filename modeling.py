@@ -1,7 +1,30 @@
+import hashlib
+import html
+import io
 import os
+import shutil
 import subprocess
+import zlib
 from matplotlib import pyplot as plt
+from matplotlib.collections import PolyCollection
+import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
+
+import gprof2dot
+from stacks import FrameNormalizer
+
+# 已渲染的调用链图按 DOT 文本的哈希保存在输出目录的这个子目录下
+RENDERED_DOT_DIR = ".call_chains"
+
+# 线程时序图的像素预算 (默认 dpi 下 40x100 英寸的画布)，超出时使用 LOD 绘制
+TIMELINE_MAX_PIXELS = 40000000
+# 合并后超过该数量的线段不再逐个绘制多边形
+TIMELINE_MAX_SEGMENTS = 200000
+# LOD 绘制时每条泳道的最小高度 (像素)
+TIMELINE_LANE_PIXELS = 12
+# LOD 图像逐条绘制时每个条带的最大高度 (像素)
+TIMELINE_STRIP_PIXELS = 256
 
 
 class TimingGraph:
@@ -150,6 +173,226 @@ class TimingGraph:
         # return tid_check_breakpoint_df_list  # Checking information on breakpoints
         pass
 
+    def gen_thread_timing_event_graph_vectorized(
+        self,
+        df: pd.DataFrame,
+        max_pixels: int = TIMELINE_MAX_PIXELS,
+        max_segments: int = TIMELINE_MAX_SEGMENTS,
+    ) -> None:
+        """
+        [向量化版] 画出与 gen_thread_timing_event_graph 相同布局的线程时序图。
+        不再逐个 CICP 调用 broken_barh、逐个线程过滤 df：所有线段先在数组上合并，
+        再作为一个 PolyCollection 绘制；颜色由调用栈标识的哈希决定，不再随机生成。
+        画布超过像素预算或线段过多时改为细节层次 (LOD) 绘制：画布按比例缩小到预算内，
+        线程合并为泳道，CICP 按像素统计占用率后作为一张图像绘制，内存和耗时与组的大小无关。
+
+        :param df: 需要包含 command、tid、ts_begin、ts_end 和 user_defined_indentical_call_stacks 列
+        :param max_pixels: 画布的像素预算
+        :param max_segments: 合并后线段数超过该值时同样使用 LOD 绘制
+        """
+        identical_event = "user_defined_indentical_call_stacks"
+        tmp_df = df.groupby(["command", "tid"], as_index=False)["ts_begin"].min()
+        tmp_df = tmp_df.sort_values(by=["ts_begin"])
+        command_list = tmp_df["command"].tolist()
+        tid_list = tmp_df["tid"].tolist()
+        tmp_length = len(tid_list)
+
+        # Set the canvas size according to the number of threads
+        if tmp_length < 10:
+            fig_width, fig_length = 30, 10
+        elif tmp_length < 30:
+            fig_width, fig_length = 30, 40
+        elif tmp_length < 300:
+            fig_width, fig_length = 40, 100
+        else:
+            fig_width, fig_length = 50, 200
+
+        barh_y_height = 1
+        barh_y_position = np.arange(2, 2 * (tmp_length + 1), 2)
+
+        # 与原实现一致：(command, tid) 的每一行画出该 tid 的全部 CICP
+        position_df = pd.DataFrame({"tid": tid_list, "y": barh_y_position[:tmp_length]})
+        segment_df = df[["tid", "ts_begin", "ts_end", identical_event]].merge(
+            position_df, on="tid"
+        )
+        key_codes, keys = pd.factorize(segment_df[identical_event])
+        y = segment_df["y"].to_numpy()
+        ts_begin = segment_df["ts_begin"].to_numpy(dtype=np.float64)
+        ts_end = segment_df["ts_end"].to_numpy(dtype=np.float64)
+        y_data = [str(command) + " " + str(tid) for command, tid in zip(command_list, tid_list)]
+        x_min = df["ts_begin"].min() - 0.05
+        x_max = df["ts_end"].max() + 0.05
+
+        dpi = plt.rcParams["figure.dpi"]
+        scale = min(1.0, np.sqrt(max_pixels / (fig_width * fig_length * dpi * dpi)))
+        fig, ax = plt.subplots(figsize=(fig_width * scale, fig_length * scale))
+        position = ax.get_position()
+        n_bins = max(1, int(position.width * fig.get_figwidth() * dpi))
+        # 间隔小于一个像素的同色线段在图上无法区分，合并后再决定绘制方式
+        merged = merge_timeline_segments(
+            y, ts_begin, ts_end, key_codes, max_gap=(x_max - x_min) / n_bins
+        )
+        if scale < 1.0 or len(merged[0]) > max_segments:
+            # 占用率按原始线段统计，合并跨过的间隔不计入占用
+            colors = stack_colors(keys)[key_codes]
+            # 每条泳道至少 TIMELINE_LANE_PIXELS 像素高，保证标签可读
+            lane_rows = int(position.height * fig.get_figheight() * dpi) // TIMELINE_LANE_PIXELS
+            n_lanes = max(1, min(tmp_length, lane_rows))
+            row_lanes = np.arange(tmp_length) * n_lanes // tmp_length
+            lane_threads = np.bincount(row_lanes, minlength=n_lanes)
+            image = timeline_occupancy(
+                row_lanes[y // 2 - 1], ts_begin, ts_end, colors, lane_threads, n_bins, x_min, x_max
+            )
+            # matplotlib 按图像在屏幕上的面积分配重采样缓冲区，分成高度不超过
+            # TIMELINE_STRIP_PIXELS 的条带逐条绘制，峰值内存只与一个条带有关
+            lane_pixels = position.height * fig.get_figheight() * dpi / n_lanes
+            lanes_per_strip = max(1, int(TIMELINE_STRIP_PIXELS // lane_pixels))
+            parts = max(1, int(np.ceil(lane_pixels * lanes_per_strip / TIMELINE_STRIP_PIXELS)))
+            for first in range(0, n_lanes, lanes_per_strip):
+                last = min(first + lanes_per_strip, n_lanes)
+                bands = np.linspace(first, last, parts + 1)
+                for band_begin, band_end in zip(bands[:-1], bands[1:]):
+                    ax.imshow(
+                        image[first:last],
+                        extent=(x_min, x_max, band_begin, band_end),
+                        origin="lower",
+                        aspect="auto",
+                        interpolation="none",
+                    )
+            first_rows = np.searchsorted(row_lanes, np.arange(n_lanes))
+            lane_labels = [
+                y_data[row] if count == 1 else f"{y_data[row]} (+{count - 1} threads)"
+                for row, count in zip(first_rows, lane_threads)
+            ]
+            ax.set_ylim(0, n_lanes)
+            ax.set_yticks(np.arange(n_lanes) + 0.5)
+            ax.set_yticklabels(lane_labels)
+        else:
+            y, ts_begin, ts_end, key_codes = merged
+            colors = stack_colors(keys)[key_codes]
+            vertices = np.empty((len(y), 4, 2))
+            vertices[:, 0, 0] = vertices[:, 1, 0] = ts_begin
+            vertices[:, 2, 0] = vertices[:, 3, 0] = ts_end
+            vertices[:, 0, 1] = vertices[:, 3, 1] = y
+            vertices[:, 1, 1] = vertices[:, 2, 1] = y + barh_y_height
+            ax.add_collection(PolyCollection(vertices, facecolors=colors))
+            ax.set_ylim(0, (tmp_length + 1) * 2)
+            ax.set_yticks(barh_y_position[0:tmp_length])
+            ax.set_yticklabels(y_data)
+
+        ax.set_xlim(x_min, x_max)
+        ax.set_xlabel("time-thread")
+        ax.grid(True)
+
+        output_file = self.output_path + "/thread_timing_evets_graph_" + self.file_name
+        fig.savefig(output_file)
+        plt.close(fig)
+
+
+def stack_colors(keys) -> np.ndarray:
+    """
+    由调用栈标识的哈希得到确定的颜色，同一个标识在不同运行、不同竞争组中颜色相同。
+    与 gen_random_color 一样，每个通道取 0x11 ~ 0xFF。
+
+    :param keys: 调用栈标识 (user_defined_indentical_call_stacks 的取值)
+    :return: (n, 3) 的 RGB 数组，取值 0 ~ 1
+    """
+    hashes = pd.util.hash_array(np.asarray(keys, dtype=object))
+    channels = np.stack(
+        [(hashes >> np.uint64(shift)) & np.uint64(0xFF) for shift in (0, 8, 16)], axis=1
+    ).astype(np.float64)
+    return (0x11 + channels * (0xFF - 0x11) / 0xFF) / 0xFF
+
+
+def timeline_occupancy(
+    lanes, ts_begin, ts_end, colors, lane_threads, n_bins, x_min, x_max
+) -> np.ndarray:
+    """
+    把线段按像素列分箱，得到每条泳道、每个像素的占用率和颜色。
+    线段两端所在的像素按覆盖比例累加，中间整像素用差分数组累加，耗时与线段数和像素数成线性。
+
+    :param lanes: 每条线段所在的泳道
+    :param ts_begin: 线段起点
+    :param ts_end: 线段终点
+    :param colors: 每条线段的 RGB 颜色，(n, 3)
+    :param lane_threads: 每条泳道包含的线程数
+    :param n_bins: 横向像素数
+    :param x_min: 横轴最小值
+    :param x_max: 横轴最大值
+    :return: (泳道数, n_bins, 4) 的 RGBA 图像，颜色为按覆盖时间加权的平均色，alpha 为占用率
+    """
+    n_lanes = len(lane_threads)
+    stride = n_bins + 1
+    bin_width = (x_max - x_min) / n_bins
+    x0 = np.clip((ts_begin - x_min) / bin_width, 0, n_bins)
+    x1 = np.clip((ts_end - x_min) / bin_width, 0, n_bins)
+    b0 = np.minimum(x0.astype(np.int64), n_bins - 1)
+    b1 = np.minimum(x1.astype(np.int64), n_bins - 1)
+    same = b0 == b1
+    base = np.asarray(lanes, dtype=np.int64) * stride
+
+    partial_index = np.concatenate([base + b0, base + b1])
+    partial_weight = np.concatenate([np.where(same, x1 - x0, b0 + 1 - x0), np.where(same, 0.0, x1 - b1)])
+    full = b1 > b0 + 1
+    diff_index = np.concatenate([base[full] + b0[full] + 1, base[full] + b1[full]])
+    diff_weight = np.concatenate([np.ones(full.sum()), -np.ones(full.sum())])
+
+    weights = np.column_stack([colors, np.ones(len(base))])
+    accumulated = np.empty((n_lanes, stride, 4))
+    for channel in range(4):
+        weight = weights[:, channel]
+        partial = np.bincount(
+            partial_index, np.concatenate([weight, weight]) * partial_weight, minlength=n_lanes * stride
+        )
+        diff = np.bincount(
+            diff_index, np.concatenate([weight[full], weight[full]]) * diff_weight, minlength=n_lanes * stride
+        )
+        accumulated[..., channel] = partial.reshape(n_lanes, stride) + np.cumsum(
+            diff.reshape(n_lanes, stride), axis=1
+        )
+    accumulated = accumulated[:, :n_bins]
+
+    coverage = accumulated[..., 3]
+    image = np.zeros((n_lanes, n_bins, 4), dtype=np.float32)
+    covered = coverage > 0
+    image[covered, :3] = accumulated[covered, :3] / coverage[covered, None]
+    image[..., 3] = np.clip(coverage / lane_threads[:, None], 0, 1)
+    return image
+
+
+def merge_timeline_segments(y, ts_begin, ts_end, key_codes, max_gap: float = 0.0) -> tuple:
+    """
+    合并同一行上相邻、颜色相同 (调用栈标识相同) 且间隔不超过 max_gap 的线段，减少需要绘制的多边形。
+    只合并按时间相邻的线段，中间隔着其他 CICP 的线段不合并，合并后不会盖住其他颜色的线段；
+    max_gap 取一个像素对应的时间时，合并跨过的空隙 (例如 filtering_operation 去掉的单样本 CICP)
+    在该分辨率下本来就看不出来。
+
+    :param y: 每条线段所在行的纵坐标
+    :param ts_begin: 线段起点
+    :param ts_end: 线段终点
+    :param key_codes: 线段的调用栈标识编号
+    :param max_gap: 可以合并的最大间隔，0 表示只合并首尾相接或重叠的线段
+    :return: 合并后的 (y, ts_begin, ts_end, key_codes)
+    """
+    order = np.lexsort((ts_begin, y))
+    y, ts_begin, ts_end, key_codes = y[order], ts_begin[order], ts_end[order], key_codes[order]
+    if len(y) == 0:
+        return y, ts_begin, ts_end, key_codes
+    starts = np.ones(len(y), dtype=bool)
+    starts[1:] = (
+        (y[1:] != y[:-1])
+        | (key_codes[1:] != key_codes[:-1])
+        | (ts_begin[1:] > ts_end[:-1] + max_gap)
+    )
+    start_index = np.flatnonzero(starts)
+    return (
+        y[start_index],
+        ts_begin[start_index],
+        np.maximum.reduceat(ts_end, start_index),
+        key_codes[start_index],
+    )
+
+
 def gen_call_chains(output_path: str, file_name: str, df: pd.DataFrame) -> None:
     """
     [优化版] 生成调用链图，直接通过管道将数据流式传输给 gprof2dot，
@@ -213,83 +456,488 @@ def gen_call_chains(output_path: str, file_name: str, df: pd.DataFrame) -> None:
     except Exception as e:
         print(f"在为 {file_name} 生成调用链图时发生错误: {e}")
 
-def output_result_file(output_path: str, file_name: str, df: pd.DataFrame) -> None:
+
+def _call_chain_function(profile: gprof2dot.Profile, frame: str):
+    """
+    按 gprof2dot PerfParser.parse_call 的规则把一帧解析为 Function，同一函数只创建一次。
+
+    :param profile: 正在构建的 gprof2dot.Profile
+    :param frame: call_stack 中的一帧 (地址 符号+偏移 (模块))
+    :return: Function，无法解析的帧返回 None
+    """
+    match = gprof2dot.PerfParser.call_re.match("\t" + str(frame))
+    if match is None:
+        return None
+    function_name = match.group("symbol")
+    if function_name:
+        function_name = gprof2dot.PerfParser.addr2_re.sub("", function_name)
+    if not function_name or function_name == "[unknown]":
+        function_name = match.group("address")
+    module = match.group("module")
+    function_id = function_name + ":" + module
+
+    function = profile.functions.get(function_id)
+    if function is None:
+        function = gprof2dot.Function(function_id, function_name)
+        function.module = os.path.basename(module)
+        function[gprof2dot.SAMPLES] = 0
+        function[gprof2dot.TOTAL_SAMPLES] = 0
+        profile.add_function(function)
+    return function
+
+
+def build_call_chains_profile(df: pd.DataFrame) -> gprof2dot.Profile:
+    """
+    直接由调用栈构建 gprof2dot.Profile，不再拼接 perf script 文本再交给 PerfParser 解析。
+    相同 stack_id 的行只处理一次，以出现次数作为权重累加，
+    结果与 gen_call_chains 中 `gprof2dot.py -f perf` 解析得到的 Profile 一致。
+
+    :param df: 包含 call_stack (以及可选的 stack_id) 列的 DataFrame
+    :return: 已计算各项比例、可直接 prune 的 Profile
+    """
+    if "stack_id" in df.columns:
+        codes, _ = pd.factorize(df["stack_id"])
+    else:
+        codes, _ = pd.factorize(df["call_stack"].map(tuple))
+    weights = np.bincount(codes) if len(codes) else np.zeros(0, dtype=np.int64)
+    # factorize 按首次出现的顺序编号，函数与调用边的插入顺序与逐行解析时相同
+    first_rows = np.unique(codes, return_index=True)[1]
+    call_stack_list = df["call_stack"].to_numpy()
+
+    profile = gprof2dot.Profile()
+    profile[gprof2dot.SAMPLES] = 0
+    for code, row in enumerate(first_rows):
+        weight = int(weights[code])
+        callchain = []
+        for frame in call_stack_list[row]:
+            function = _call_chain_function(profile, frame)
+            if function is None:
+                break
+            callchain.append(function)
+        if not callchain:
+            continue
+
+        callee = callchain[0]
+        callee[gprof2dot.SAMPLES] += weight
+        profile[gprof2dot.SAMPLES] += weight
+        for caller in callchain[1:]:
+            call = caller.calls.get(callee.id)
+            if call is None:
+                call = gprof2dot.Call(callee.id)
+                call[gprof2dot.SAMPLES2] = weight
+                caller.add_call(call)
+            else:
+                call[gprof2dot.SAMPLES2] += weight
+            callee = caller
+        for function in set(callchain):
+            function[gprof2dot.TOTAL_SAMPLES] += weight
+
+    # 与 PerfParser.parse 相同的派生数据计算 (totalMethod 为默认的 callratios)
+    profile.validate()
+    profile.find_cycles()
+    profile.ratio(gprof2dot.TIME_RATIO, gprof2dot.SAMPLES)
+    profile.call_ratios(gprof2dot.SAMPLES2)
+    profile.integrate(gprof2dot.TOTAL_TIME_RATIO, gprof2dot.TIME_RATIO)
+    return profile
+
+
+def call_chains_dot(df: pd.DataFrame, node_thres: float = 0.0, edge_thres: float = 0.0) -> str:
+    """
+    在进程内生成调用链图的 DOT 文本，等价于 `gprof2dot.py -f perf -n0 -e0`。
+
+    :param df: 包含调用栈信息的 DataFrame
+    :param node_thres: 节点裁剪阈值 (百分比，对应 gprof2dot 的 -n)
+    :param edge_thres: 调用边裁剪阈值 (百分比，对应 gprof2dot 的 -e)
+    :return: DOT 文本
+    """
+    profile = build_call_chains_profile(df)
+    profile.prune(node_thres / 100.0, edge_thres / 100.0, None, False)
+    output = io.StringIO()
+    gprof2dot.DotWriter(output).graph(profile, gprof2dot.themes["color"])
+    return output.getvalue()
+
+
+def _joined_unique(df: pd.DataFrame, column: str) -> pd.Series:
+    """
+    每个调用栈去重、排序后的 column 取值，以逗号连接。
+
+    :param df: 竞争组的 CICP
+    :param column: tid 或 command
+    :return: 以 function_call_stack 为索引的 Series
+    """
+    pairs = df[["function_call_stack", column]].drop_duplicates()
+    if len(pairs) == 0:
+        return pd.Series([], dtype=object)
+    stack_codes, call_stacks = pd.factorize(pairs["function_call_stack"])
+    values = pairs[column].to_numpy()
+    order = np.lexsort((values, stack_codes))
+    stack_codes = stack_codes[order]
+    strings = [str(value) for value in values[order]]
+    bounds = np.flatnonzero(np.diff(stack_codes)) + 1
+    begins = np.concatenate([[0], bounds]).tolist()
+    ends = np.concatenate([bounds, [len(strings)]]).tolist()
+    joined = [",".join(strings[begin:end]) for begin, end in zip(begins, ends)]
+    return pd.Series(joined, index=call_stacks[stack_codes[begins]])
+
+
+def stack_statistics(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    竞争组中每个调用栈的统计，由一次 groupby 得到，文本报告和 results_store 的 stacks 表都由它生成。
+    thread_list / process_list 为去重、排序后以逗号连接的线程和进程 (_joined_unique)。
+
+    :param df: 竞争组的 CICP
+    :return: 以 function_call_stack 为索引、按 ts_begin 排序 (即 "Function call stack chain N" 的顺序)
+             的 DataFrame
+    """
+    df = df.assign(busy_time=df["ts_end"] - df["ts_begin"])
+    stacks_df = df.groupby("function_call_stack").agg(
+        top_function=("top_function", "first"),
+        cicps=("tid", "size"),
+        threads=("tid", "nunique"),
+        processes=("command", "nunique"),
+        ts_begin=("ts_begin", "min"),
+        ts_end=("ts_end", "max"),
+        samples=("duration_length", "sum"),
+        busy_time=("busy_time", "sum"),
+    )
+    stacks_df["thread_list"] = _joined_unique(df, "tid")
+    stacks_df["process_list"] = _joined_unique(df, "command")
+    return stacks_df.sort_values(by=["ts_begin"])
+
+
+def _result_lines_vectorized(
+    file_name: str, df: pd.DataFrame, stacks_df: pd.DataFrame = None
+) -> tuple:
+    """
+    [向量化版] 生成竞争组文本报告的内容：每个调用栈的时间范围、
+    线程和进程由一次 groupby 得到，不再把各列聚合成 Python 列表、逐行 df.iloc 取值。
+    线程和进程按排序后的顺序输出 (原实现为 set 的迭代顺序)。
+
+    :param file_name: 结果文件名 (res_N)
+    :param df: 竞争组的 CICP
+    :param stacks_df: 已经算好的 stack_statistics(df)，None 时在这里计算
+    :return: (组文件 res_N 的行, 追加到汇总文件 res 的行)
+    """
+    if stacks_df is None:
+        stacks_df = stack_statistics(df)
+    ts_min = stacks_df["ts_begin"].min()
+    ts_max = stacks_df["ts_end"].max()
+
+    separator = "=========================================="
+    output_result = [separator, "Time period: " + str(ts_min) + " ~ " + str(ts_max)]
+    all_res_list = [
+        separator,
+        "Contention group " + file_name.split("_")[1] + " :",
+        "Duration: " + str(ts_max - ts_min),
+        "Function call stacks: " + str(len(stacks_df)),
+        "Total threads: " + str(df["tid"].nunique()),
+        "Total processes: " + str(df["command"].nunique()),
+        "Detailed information:" + file_name,
+    ]
+    for i, (call_stack, processes, threads) in enumerate(
+        zip(stacks_df.index, stacks_df["process_list"], stacks_df["thread_list"]), start=1
+    ):
+        output_result += [
+            "------------------------------------------",
+            "Function call stack chain " + str(i),
+            call_stack,
+            "Processes: " + processes,
+            "Threads: " + threads,
+        ]
+    return output_result, all_res_list
+
+
+def _render_dot(dot_source: str, svg_filename: str) -> bool:
     """
+    调用一次 dot 把 DOT 文本渲染为 SVG，先写临时文件再重命名，中断时不会留下不完整的 SVG。
 
-    :param output_path:
-    :param file_name:
-    :param df:
-    :return:
+    :param dot_source: DOT 文本
+    :param svg_filename: 输出的 SVG 文件
+    :return: 是否渲染成功
     """
-    output_result = []
-    all_res_list = []
-    df = df.groupby(["function_call_stack"], as_index=False).aggregate(
-        lambda x: list(x)
+    tmp_filename = svg_filename + ".tmp"
+    result = subprocess.run(
+        ["dot", "-Tsvg", "-o", tmp_filename], input=dot_source, text=True
     )
-    df["ts_begin"] = df["ts_begin"].apply(lambda x: min(x))
-    df["ts_end"] = df["ts_end"].apply(lambda x: max(x))
-    df = df.sort_values(by=["ts_begin"])
-    ts_min = df["ts_begin"].min()
-    ts_max = df["ts_end"].max()
-    tmp_str = "=========================================="
-    output_result.append(tmp_str)
-    all_res_list.append(tmp_str)
-
-    file_name_num = file_name.split("_")[1]
-    tmp_str = "Contention group " + str(file_name_num) + " :"
-    all_res_list.append(tmp_str)
-    tmp_str = "Time period: " + str(ts_min) + " ~ " + str(ts_max)
-    output_result.append(tmp_str)
-    tmp_str = "Duration: " + str(ts_max - ts_min)
-    all_res_list.append(tmp_str)
-    df_length = len(df)
-    tmp_str = "Function call stacks: " + str(df_length)
-    all_res_list.append(tmp_str)
-    all_threads_list = df["tid"].tolist()
-    tmp_list = []
-    for i in all_threads_list:
-        tmp_list += i
-    all_threads_list = list(set(tmp_list))
-    all_threads = len(all_threads_list)
-    tmp_str = "Total threads: " + str(all_threads)
-    all_res_list.append(tmp_str)
-
-    all_command_list = df["command"].tolist()
-    tmp_list = []
-    for i in all_command_list:
-        tmp_list += i
-    all_command_list = list(set(tmp_list))
-    all_command = len(all_command_list)
-    tmp_str = "Total processes: " + str(all_command)
-    all_res_list.append(tmp_str)
-    tmp_str = "Detailed information:" + file_name
-    all_res_list.append(tmp_str)
-
-    for i in range(df_length):
-        tmp_str = "------------------------------------------"
-        output_result.append(tmp_str)
-        tmp_str = "Function call stack chain " + str(i + 1)
-        tmp_call_stack_chain = df.iloc[i]["function_call_stack"]
-        output_result.append(tmp_str)
-        output_result.append(tmp_call_stack_chain)
-
-        tmp_command = df.iloc[i]["command"]
-        tmp_command = list(set(tmp_command))
-        tmp_str = "Processes: " + ",".join(str(x) for x in tmp_command)
-        output_result.append(tmp_str)
-
-        tmp_tid = df.iloc[i]["tid"]
-        tmp_tid = list(set(tmp_tid))
-        tmp_str = "Threads: " + ",".join(str(x) for x in tmp_tid)
-        output_result.append(tmp_str)
-
-    output_file = output_path + "/" + file_name
-    with open(output_file, "w") as f:
-        for each_line in output_result:
-            f.write(str(each_line) + "\n")
-
-    all_res_file = output_path + "/" + "res"
-    with open(all_res_file, "a+") as f:
-        for each_line in all_res_list:
-            f.write(str(each_line) + "\n")
-    pass
+    if result.returncode != 0:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        return False
+    os.replace(tmp_filename, svg_filename)
+    return True
+
+
+def render_call_chains(output_path: str, dot_sources: dict, n_jobs: int = -1) -> int:
+    """
+    批量渲染调用链图：先收集所有竞争组的 DOT 文本，再用大小等于 CPU 核数的 dot 进程池渲染。
+    渲染结果以 DOT 文本的 SHA-1 命名保存在 output_path/.call_chains 下，
+    哈希已有 SVG 的组 (之前运行过，或与本次其他组内容相同) 不再调用 dot，只复制为 call_chains_<组名>.svg。
+
+    :param output_path: 结果输出目录
+    :param dot_sources: {组名: DOT 文本}，组名即 res_1 这样的结果文件名
+    :param n_jobs: 同时运行的 dot 进程数，-1 表示 CPU 核数
+    :return: 实际调用 dot 渲染的次数
+    """
+    if shutil.which("dot") is None:
+        print("错误: 无法执行命令。请确保 'dot' (来自Graphviz) 在您的系统 PATH 中。")
+        return 0
+    rendered_dir = os.path.join(output_path, RENDERED_DOT_DIR)
+    os.makedirs(rendered_dir, exist_ok=True)
+
+    rendered_files = {}
+    pending = {}
+    for file_name, dot_source in dot_sources.items():
+        digest = hashlib.sha1(dot_source.encode("utf-8")).hexdigest()
+        rendered_file = os.path.join(rendered_dir, digest + ".svg")
+        rendered_files[file_name] = rendered_file
+        if not os.path.exists(rendered_file):
+            pending[rendered_file] = dot_source
+
+    # dot 是独立的子进程，线程只负责等待，进程池的大小就是并发的 dot 数
+    results = Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(_render_dot)(dot_source, rendered_file)
+        for rendered_file, dot_source in pending.items()
+    )
+    for (rendered_file, _), ok in zip(pending.items(), results):
+        if not ok:
+            print(f"警告: dot 渲染 {os.path.basename(rendered_file)} 失败。")
+
+    for file_name, rendered_file in rendered_files.items():
+        if os.path.exists(rendered_file):
+            shutil.copyfile(
+                rendered_file, os.path.join(output_path, f"call_chains_{file_name}.svg")
+            )
+    return len(pending)
+
+
+def group_summary(
+    file_name: str,
+    df: pd.DataFrame,
+    spans: pd.DataFrame = None,
+    stacks_df: pd.DataFrame = None,
+) -> tuple:
+    """
+    竞争组的结构化摘要，对应 results_store 中 groups 表的一行、stacks 表和 spans 表的若干行。
+
+    :param file_name: 结果文件名 (res_N)，N 作为 group_id
+    :param df: 竞争组的 CICP (合并重复的竞争组时为第一次出现的那一组)
+    :param spans: filtering.occurrence_spans 的结果，None 表示该组只出现一次
+    :param stacks_df: 已经算好的 stack_statistics(df)，None 时在这里计算
+    :return: (组摘要 dict, 每个调用栈一行的 DataFrame, 每次出现一行的 DataFrame)
+    """
+    group_id = int(file_name.split("_")[1])
+    if stacks_df is None:
+        stacks_df = stack_statistics(df)
+    # 与文本报告中 "Function call stack chain N" 的顺序相同
+    stacks_df = stacks_df.reset_index()
+    stacks_df.insert(0, "chain", np.arange(1, len(stacks_df) + 1))
+    stacks_df.insert(0, "group_id", group_id)
+
+    group = {
+        "group_id": group_id,
+        "file_name": file_name,
+        "tocc_id": int(df["tocc_id"].iloc[0]) if "tocc_id" in df.columns else None,
+        "subtocc_id": int(df["subtocc_id"].iloc[0]) if "subtocc_id" in df.columns else None,
+        "execution_mode": int(df["execution_mode"].iloc[0]),
+        "ts_begin": float(df["ts_begin"].min()),
+        "ts_end": float(df["ts_end"].max()),
+        "duration": float(df["ts_end"].max() - df["ts_begin"].min()),
+        "cicps": len(df),
+        "stacks": len(stacks_df),
+        "threads": int(df["tid"].nunique()),
+        "processes": int(df["command"].nunique()),
+        "samples": int(df["duration_length"].sum()),
+    }
+    if spans is None:
+        spans = pd.DataFrame(
+            [
+                {
+                    "tocc_id": group["tocc_id"],
+                    "subtocc_id": group["subtocc_id"],
+                    "ts_begin": group["ts_begin"],
+                    "ts_end": group["ts_end"],
+                    "duration": group["duration"],
+                    "cicps": group["cicps"],
+                }
+            ]
+        )
+    group["occurrences"] = len(spans)
+    group["total_duration"] = float(spans["duration"].sum())
+    spans_df = spans.assign(group_id=group_id)
+    return group, stacks_df, spans_df
+
+
+def output_result_summary(
+    output_path: str, file_name: str, df: pd.DataFrame, spans: pd.DataFrame = None
+) -> tuple:
+    """
+    [单写者版] 写出组文件 res_N，不再由各个工作进程以追加方式写汇总文件 res，
+    而是把汇总行和结构化摘要返回给主进程，由主进程统一写出 res 和 results.sqlite。
+    给出 spans (合并了重复出现的竞争组) 时，报告中还会列出出现次数、总时长和每次出现的时间范围。
+
+    :param output_path: 结果输出目录
+    :param file_name: 结果文件名 (res_N)
+    :param df: 竞争组的 CICP
+    :param spans: filtering.occurrence_spans 的结果
+    :return: (汇总文件 res 的行, 组摘要 dict, 调用栈统计 DataFrame, 出现时间范围 DataFrame)
+    """
+    stacks_df = stack_statistics(df)
+    output_result, all_res_list = _result_lines_vectorized(file_name, df, stacks_df)
+    group, stacks_df, spans_df = group_summary(file_name, df, spans, stacks_df)
+    if spans is not None:
+        occurrence_lines = [
+            "Occurrences: " + str(group["occurrences"]),
+            "Total duration: " + str(group["total_duration"]),
+        ]
+        all_res_list[-1:-1] = occurrence_lines
+        output_result[2:2] = occurrence_lines + ["Time spans:"] + [
+            "  " + str(ts_begin) + " ~ " + str(ts_end)
+            for ts_begin, ts_end in zip(spans["ts_begin"], spans["ts_end"])
+        ]
+    with open(os.path.join(output_path, file_name), "w") as f:
+        f.write("".join(str(each_line) + "\n" for each_line in output_result))
+    return all_res_list, group, stacks_df, spans_df
+
+
+def folded_stacks(df: pd.DataFrame, normalizer: FrameNormalizer = None) -> pd.Series:
+    """
+    把竞争组的调用栈转换为 Brendan Gregg 的折叠栈格式 (栈底在前，以分号分隔)，
+    计数为 CICP 的 duration_length (样本数) 之和。
+    帧取自 CICP 的调用栈 key (user_defined_indentical_call_stacks，即按 --normalize、中断折叠和
+    degrees_of_freedom 处理后的调用栈)，计数也按 key 汇总，被中断打断的第一个样本不会把整个 CICP
+    记到中断路径上。没有 key 列时才由 normalizer 规范化 call_stack，相同 stack_id 的行只转换一次。
+
+    :param df: 包含 user_defined_indentical_call_stacks 或 call_stack 列、duration_length
+               (以及可选的 stack_id) 列的 DataFrame
+    :param normalizer: 没有 key 列时使用的帧名规范化，默认只保留函数名 (FrameNormalizer("function"))
+    :return: 以折叠栈为索引、计数为值的 Series，按折叠栈排序
+    """
+    durations = df["duration_length"].to_numpy()
+    if "user_defined_indentical_call_stacks" in df.columns:
+        # key 的帧顺序总是栈底在前，与折叠栈的顺序相同；帧名中的分号在生成 key 时已替换为冒号
+        codes, keys = pd.factorize(df["user_defined_indentical_call_stacks"])
+        if len(codes) == 0:
+            return pd.Series([], dtype=np.int64)
+        weights = np.bincount(codes, weights=durations, minlength=len(keys)).astype(np.int64)
+        counts = pd.Series(weights, index=[str(key) for key in keys])
+    else:
+        if normalizer is None:
+            normalizer = FrameNormalizer("function")
+        if "stack_id" in df.columns:
+            codes, _ = pd.factorize(df["stack_id"])
+        else:
+            codes, _ = pd.factorize(df["call_stack"].map(tuple))
+        if len(codes) == 0:
+            return pd.Series([], dtype=np.int64)
+        weights = np.bincount(codes, weights=durations).astype(np.int64)
+        first_rows = np.unique(codes, return_index=True)[1]
+        call_stack_list = df["call_stack"].to_numpy()
+        # call_stack 在加载时已经反转为栈底在前，与折叠栈的顺序相同
+        # FrameNormalizer 的帧名中没有分号，与 key 的帧一致
+        folded = [";".join(normalizer.stack_labels(call_stack_list[row])) for row in first_rows]
+        counts = pd.Series(weights, index=folded)
+    counts = counts[counts.index != ""]
+    return counts.groupby(level=0).sum().sort_index()
+
+
+def _flame_color(name: str) -> str:
+    """flamegraph.pl 的 hot 配色，由帧名的 CRC32 决定，同名的帧颜色相同。"""
+    value = zlib.crc32(name.encode("utf-8"))
+    red = 205 + (value & 0xFF) * 50 // 255
+    green = ((value >> 8) & 0xFF) * 230 // 255
+    blue = ((value >> 16) & 0xFF) * 55 // 255
+    return f"rgb({red},{green},{blue})"
+
+
+def flamegraph_svg(
+    folded: pd.Series, title: str = "Flame Graph", width: int = 1200, frame_height: int = 16
+) -> str:
+    """
+    由折叠栈生成独立的 SVG 火焰图 (不依赖外部进程和脚本)。
+    与 flamegraph.pl 相同：按栈排序后合并相同的前缀，每个帧的宽度与其计数成正比，栈底在下。
+
+    :param folded: folded_stacks 的结果
+    :param title: 图的标题
+    :param width: 图的宽度 (像素)
+    :param frame_height: 每层帧的高度 (像素)
+    :return: SVG 文本
+    """
+    stacks = sorted(zip((stack.split(";") for stack in folded.index), folded.tolist()))
+    # (depth, name, start, end)，start / end 为累计计数
+    frames = []
+    open_frames = []
+    total = 0
+    for stack, count in stacks:
+        same = 0
+        while same < min(len(stack), len(open_frames)) and open_frames[same][0] == stack[same]:
+            same += 1
+        while len(open_frames) > same:
+            name, start = open_frames.pop()
+            frames.append((len(open_frames), name, start, total))
+        for name in stack[same:]:
+            open_frames.append((name, total))
+        total += count
+    while open_frames:
+        name, start = open_frames.pop()
+        frames.append((len(open_frames), name, start, total))
+
+    pad_top, pad_bottom, pad_side, font_size = 36, 10, 10, 12
+    max_depth = max((depth for depth, _, _, _ in frames), default=-1) + 1
+    height = pad_top + max_depth * frame_height + pad_bottom
+    scale = (width - 2 * pad_side) / total if total else 0.0
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        f'viewBox="0 0 {width} {height}" font-family="Verdana" font-size="{font_size}">',
+        f'<rect x="0" y="0" width="{width}" height="{height}" fill="#f8f8f8"/>',
+        f'<text x="{width / 2}" y="24" text-anchor="middle" font-size="17">{html.escape(title)}</text>',
+    ]
+    for depth, name, start, end in sorted(frames, key=lambda frame: (frame[0], frame[2])):
+        frame_width = (end - start) * scale
+        if frame_width < 0.1:
+            continue
+        x = pad_side + start * scale
+        y = height - pad_bottom - (depth + 1) * frame_height
+        escaped = html.escape(name)
+        tooltip = f"{escaped} ({end - start} samples, {(end - start) * 100 / total:.2f}%)"
+        parts.append(
+            f'<g><title>{tooltip}</title><rect x="{x:.1f}" y="{y}" width="{frame_width:.1f}" '
+            f'height="{frame_height - 1}" fill="{_flame_color(name)}" rx="2" ry="2"/>'
+        )
+        # 与 flamegraph.pl 一样按平均字宽截断帧名，放不下时不显示
+        characters = int(frame_width / (font_size * 0.59))
+        if characters >= 3:
+            label = name if len(name) <= characters else name[: characters - 2] + ".."
+            parts.append(
+                f'<text x="{x + 3:.1f}" y="{y + frame_height - 5}">{html.escape(label)}</text>'
+            )
+        parts.append("</g>")
+    parts.append("</svg>")
+    return "\n".join(parts) + "\n"
+
+
+def output_folded_stacks(
+    output_path: str,
+    file_name: str,
+    df: pd.DataFrame,
+    normalizer: FrameNormalizer = None,
+    flamegraph: bool = False,
+) -> pd.Series:
+    """
+    写出竞争组的折叠栈 folded_<组名>.txt (每行 "帧;帧;帧 计数")，可直接交给 flamegraph.pl、
+    speedscope 等工具；flamegraph 为 True 时同时写出 flamegraph_<组名>.svg。
+
+    :param output_path: 结果输出目录
+    :param file_name: 结果文件名 (res_N)
+    :param df: 竞争组的 CICP
+    :param normalizer: 本次运行的帧名规范化 (main.py 的 --normalize / --fold-interrupts)，
+                       df 没有调用栈 key 列时使用，见 folded_stacks
+    :param flamegraph: 是否生成 SVG 火焰图
+    :return: folded_stacks 的结果
+    """
+    folded = folded_stacks(df, normalizer)
+    with open(os.path.join(output_path, f"folded_{file_name}.txt"), "w") as f:
+        f.write("".join(f"{stack} {count}\n" for stack, count in folded.items()))
+    if flamegraph:
+        with open(os.path.join(output_path, f"flamegraph_{file_name}.svg"), "w") as f:
+            f.write(flamegraph_svg(folded, f"Contention group {file_name.split('_')[1]}"))
+    return folded
@@ -0,0 +1,107 @@
+"""TCSA results store (results.sqlite): the per-group results of a run as SQLite tables.
+
+Tables:
+
+    groups   one row per contention group (sub-TOCC)
+             group_id, file_name, tocc_id, subtocc_id, execution_mode,
+             ts_begin, ts_end, duration, cicps, stacks, threads, processes, samples,
+             signature, occurrences, total_duration
+    stacks   one row per distinct function call stack of a group
+             group_id, chain (the "Function call stack chain" number of the text report),
+             function_call_stack, top_function, cicps, threads, processes,
+             ts_begin, ts_end, samples, busy_time, thread_list, process_list
+    spans    one row per occurrence of a group
+             group_id, tocc_id, subtocc_id, ts_begin, ts_end, duration, cicps
+
+samples is the sum of duration_length (number of perf samples), busy_time the sum of
+ts_end - ts_begin over the CICPs, signature is filtering.group_signatures of the group.
+When recurring groups are collapsed (main.py --dedup), a group has one spans row per
+occurrence and its other columns describe the first occurrence.
+
+The report workers only compute the rows, the parent process writes the whole store once,
+to a temporary file that is renamed into place.
+
+Usage:
+    python results_store.py <output_path>/results.sqlite
+"""
+import os
+import sqlite3
+import sys
+
+import pandas as pd
+
+RESULTS_FILE = "results.sqlite"
+GROUP_COLUMNS = [
+    "group_id", "file_name", "tocc_id", "subtocc_id", "execution_mode", "ts_begin", "ts_end",
+    "duration", "cicps", "stacks", "threads", "processes", "samples",
+    "signature", "occurrences", "total_duration",
+]
+STACK_COLUMNS = [
+    "group_id", "chain", "function_call_stack", "top_function", "cicps", "threads", "processes",
+    "ts_begin", "ts_end", "samples", "busy_time", "thread_list", "process_list",
+]
+SPAN_COLUMNS = ["group_id", "tocc_id", "subtocc_id", "ts_begin", "ts_end", "duration", "cicps"]
+
+
+def write_results(
+    results_path: str,
+    groups_df: pd.DataFrame,
+    stacks_df: pd.DataFrame,
+    spans_df: pd.DataFrame = None,
+) -> None:
+    """一次性写出结果库，先写临时文件再重命名，读者不会看到写了一半的结果。
+
+    :param results_path: 结果库路径，通常为 <output_path>/results.sqlite。
+    :param groups_df: 每个竞争组一行的摘要。
+    :param stacks_df: 每个竞争组中每个调用栈一行的统计。
+    :param spans_df: 每个竞争组每次出现一行的时间范围。
+    """
+    if spans_df is None:
+        spans_df = pd.DataFrame()
+    tmp_path = f"{results_path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    connection = sqlite3.connect(tmp_path)
+    try:
+        groups_df.reindex(columns=GROUP_COLUMNS).to_sql("groups", connection, index=False)
+        stacks_df.reindex(columns=STACK_COLUMNS).to_sql("stacks", connection, index=False)
+        spans_df.reindex(columns=SPAN_COLUMNS).to_sql("spans", connection, index=False)
+        connection.execute("CREATE INDEX stacks_group_id ON stacks (group_id)")
+        connection.execute("CREATE INDEX spans_group_id ON spans (group_id)")
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(tmp_path, results_path)
+
+
+def load_results(results_path: str) -> tuple:
+    """读取结果库。
+
+    :param results_path: write_results 写出的结果库路径。
+    :return: (groups_df, stacks_df, spans_df)
+    """
+    connection = sqlite3.connect(results_path)
+    try:
+        groups_df = pd.read_sql("SELECT * FROM groups ORDER BY group_id", connection)
+        stacks_df = pd.read_sql("SELECT * FROM stacks ORDER BY group_id, chain", connection)
+        spans_df = pd.read_sql("SELECT * FROM spans ORDER BY group_id, ts_begin", connection)
+    finally:
+        connection.close()
+    return groups_df, stacks_df, spans_df
+
+
+def write_text_file(file_path: str, lines: list) -> None:
+    """一次写出文本文件，同样先写临时文件再重命名。
+
+    :param file_path: 输出文件路径。
+    :param lines: 文本行，不含换行符。
+    """
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write("".join(str(line) + "\n" for line in lines))
+    os.replace(tmp_path, file_path)
+
+
+if __name__ == "__main__":
+    groups_df, stacks_df, spans_df = load_results(sys.argv[1])
+    print(groups_df.to_string(index=False))
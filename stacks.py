@@ -0,0 +1,406 @@
+import re
+
+import numpy as np
+
+
+def object_array(values) -> np.ndarray:
+    """把序列逐个放入一维 object 数组 (避免 NumPy 把嵌套的列表展开成多维数组)。"""
+    array = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        array[i] = value
+    return array
+
+
+def encode_strings(values) -> tuple:
+    """把字符串列表编码为 (UTF-8 字节数组, 偏移数组)，便于以列式数组保存。"""
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return data, offsets
+
+
+def decode_strings(data: np.ndarray, offsets: np.ndarray) -> list:
+    """encode_strings 的逆操作。"""
+    blob = np.asarray(data, dtype=np.uint8).tobytes()
+    offsets = np.asarray(offsets).tolist()
+    return [
+        blob[begin:end].decode("utf-8") for begin, end in zip(offsets[:-1], offsets[1:])
+    ]
+
+
+# 内核地址空间的起始地址 (大于等于该地址的帧属于内核态)。
+KERNEL_BOUNDARIES = {
+    "x86_64": 0xFFFF800000000000,  # 4 级页表的规范地址高半部分
+    "x86": 0xC0000000,  # 32 位 3G/1G 划分
+    "arm64": 0xFFF0000000000000,  # 覆盖 48 / 52 位虚拟地址
+}
+# auto: 与原来的 judge_execution_mode 相同，大于 32 位的地址按 64 位内核代码段
+# (0xffffffff80000000 起) 判断，其余按 32 位划分判断。
+AUTO_KERNEL_BOUNDARY_64 = 0xFFFFFFFF80000000
+
+
+def parse_kernel_boundary(value: str):
+    """解析 --kernel-boundary 参数：auto、预设名称 (x86_64 / x86 / arm64) 或者十六进制地址。"""
+    if value == "auto" or value in KERNEL_BOUNDARIES:
+        return value
+    try:
+        return int(value, 16)
+    except ValueError:
+        raise ValueError(
+            f"unknown kernel boundary {value!r}, expected auto, "
+            f"{', '.join(KERNEL_BOUNDARIES)} or a hexadecimal address"
+        ) from None
+
+
+def kernel_address_mask(addresses, kernel_boundary="auto") -> np.ndarray:
+    """
+    :param addresses: uint64 地址数组。
+    :param kernel_boundary: auto、KERNEL_BOUNDARIES 中的预设名称或者内核地址空间的起始地址。
+    :return: 每个地址是否位于内核地址空间的布尔数组。
+    """
+    addresses = np.asarray(addresses, dtype=np.uint64)
+    if kernel_boundary == "auto":
+        return np.where(
+            addresses > np.uint64(0xFFFFFFFF),
+            addresses >= np.uint64(AUTO_KERNEL_BOUNDARY_64),
+            addresses >= np.uint64(KERNEL_BOUNDARIES["x86"]),
+        )
+    boundary = KERNEL_BOUNDARIES.get(kernel_boundary, kernel_boundary)
+    return addresses >= np.uint64(boundary)
+
+
+# 帧名规范化模式: none 保留 "符号+偏移 (模块)"，offset 去掉偏移，function 只保留函数名，module 只保留模块。
+NORMALIZATION_MODES = ("none", "offset", "function", "module")
+# 中断 / 异常入口函数 (x86-64 的 asm_sysvec_*、asm_common_interrupt、asm_exc_*，arm64 的 el1h_64_irq 等)。
+INTERRUPT_FRAME_PATTERN = r"^(asm_)?(sysvec_\w+|common_interrupt|exc_\w+)$|^el[01]h?_64_(irq|fiq|sync)"
+
+
+class FrameNormalizer:
+    """帧名规范化。
+
+    同一函数内不同指令处的样本 (例如 check_and_acquire_lock+0xf 与 +0x12) 规范化后得到相同的帧名，
+    从而合并为更少、更长的 CICP。fold_pattern 匹配的函数 (通常是中断入口) 及其之上的帧会被折叠 (去掉)，
+    被中断打断的样本与未被打断的样本得到相同的调用栈 key。每个唯一帧行只规范化一次。
+    """
+
+    def __init__(self, mode: str = "none", fold_pattern: str = None) -> None:
+        if mode not in NORMALIZATION_MODES:
+            raise ValueError(
+                f"unknown normalization mode {mode!r}, expected one of {NORMALIZATION_MODES}"
+            )
+        self.mode = mode
+        self.fold_pattern = fold_pattern
+        self._fold_regex = re.compile(fold_pattern) if fold_pattern else None
+        self._labels = {}  # frame line -> label, None for folded frames
+
+    def label(self, line: str):
+        """帧行规范化后的帧名 (其中的分号替换为冒号)，被折叠的帧返回 None。"""
+        try:
+            return self._labels[line]
+        except KeyError:
+            pass
+        # address symbol+offset (module)
+        fields = line.split()
+        symbol = " ".join(fields[1:-1])
+        module = fields[-1] if len(fields) > 1 else ""
+        function = symbol.rpartition("+0x")[0] or symbol
+        if self._fold_regex is not None and self._fold_regex.search(function):
+            label = None
+        elif self.mode == "offset":
+            label = f"{function} {module}"
+        elif self.mode == "function":
+            label = function
+        elif self.mode == "module":
+            label = module
+        else:
+            label = " ".join(fields[1:])
+        if label is not None:
+            # 调用栈 key 和折叠栈都以分号分隔帧，帧名中的分号 (例如 C++ 的 operator;) 替换为冒号
+            label = label.replace(";", ":")
+        self._labels[line] = label
+        return label
+
+    def stack_labels(self, call_stack: list) -> list:
+        """调用栈 (栈底在前) 中每一帧规范化后的帧名，遇到第一个被折叠的帧时截断。"""
+        labels = []
+        for line in call_stack:
+            label = self.label(line)
+            if label is None:
+                break
+            labels.append(label)
+        return labels
+
+
+class FrameTable:
+    """帧字典。
+
+    perf script 调用栈中的每一种帧行 (例如
+    ``7b124bd2f21d __GI___clone3+0x2c (/usr/lib/x86_64-linux-gnu/libc.so.6)``)
+    只保存并解析一次，得到地址、符号、偏移和模块。
+    """
+
+    def __init__(self) -> None:
+        self.lines = []  # frame_id -> frame line
+        self._index = {}  # frame line -> frame_id
+        self._parsed = None
+        self._parsed_length = 0
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    def intern(self, line: str) -> int:
+        frame_id = self._index.get(line)
+        if frame_id is None:
+            frame_id = len(self.lines)
+            self._index[line] = frame_id
+            self.lines.append(line)
+        return frame_id
+
+    def parsed(self) -> dict:
+        """解析所有帧行，结果按 frame_id 排列，帧字典增长后才会重新解析新增的部分。
+
+        :return: {"address": uint64 数组, "symbol": 带偏移的符号 (如 "main+0x2fb"),
+                  "function": 函数名, "offset": 偏移, "module": 模块,
+                  "key": 符号和模块 (不含地址，用于比较调用栈是否相同)}
+        """
+        if self._parsed is None:
+            self._parsed = {
+                "address": [],
+                "symbol": [],
+                "function": [],
+                "offset": [],
+                "module": [],
+                "key": [],
+            }
+        parsed = self._parsed
+        for line in self.lines[self._parsed_length :]:
+            # address symbol+offset (module)
+            fields = line.split()
+            try:
+                address = int(fields[0], 16)
+            except (IndexError, ValueError):
+                address = 0
+            symbol = " ".join(fields[1:-1])
+            function, _, offset = symbol.rpartition("+0x")
+            if not function:
+                function, offset = symbol, ""
+            parsed["address"].append(address)
+            parsed["symbol"].append(symbol)
+            parsed["function"].append(function)
+            parsed["offset"].append(int(offset, 16) if offset else 0)
+            parsed["module"].append(fields[-1].strip("()") if len(fields) > 1 else "")
+            parsed["key"].append(" ".join(fields[1:]))
+        self._parsed_length = len(self.lines)
+
+        return {
+            "address": np.array(parsed["address"], dtype=np.uint64),
+            "symbol": object_array(parsed["symbol"]),
+            "function": object_array(parsed["function"]),
+            "offset": np.array(parsed["offset"], dtype=np.int64),
+            "module": object_array(parsed["module"]),
+            "key": object_array(parsed["key"]),
+        }
+
+
+class StackTable:
+    """调用栈字典。
+
+    每个唯一的调用栈以帧 id 元组 (栈底在前) 的形式只保存一次，
+    样本 / CICP 只需要携带一个 int32 的 stack_id，所有按调用栈派生的列都可以
+    先对唯一调用栈计算一次，再通过 take 广播到每一行。
+    """
+
+    def __init__(self, frames: FrameTable = None) -> None:
+        self.frames = frames if frames is not None else FrameTable()
+        self.stacks = []  # stack_id -> tuple of frame ids
+        self._index = {}  # tuple of frame ids -> stack_id
+
+    def __len__(self) -> int:
+        return len(self.stacks)
+
+    def intern(self, frame_ids: tuple) -> int:
+        """返回帧 id 元组对应的 stack_id，未出现过的调用栈会被追加到字典中。"""
+        stack_id = self._index.get(frame_ids)
+        if stack_id is None:
+            stack_id = len(self.stacks)
+            self._index[frame_ids] = stack_id
+            self.stacks.append(frame_ids)
+        return stack_id
+
+    def intern_lines(self, call_stack: list) -> int:
+        """
+        :param call_stack: 帧行列表，顺序与 data_loading 的 call_stack 相同 (栈底在前)。
+        :return: stack_id
+        """
+        intern_frame = self.frames.intern
+        return self.intern(tuple([intern_frame(line) for line in call_stack]))
+
+    def folded_stack_ids(self, normalizer: FrameNormalizer = None) -> np.ndarray:
+        """每个唯一调用栈折叠后 (只保留 normalizer.stack_labels 保留的帧，即去掉被折叠的帧及其之上的帧)
+        的 stack_id，下标即原来的 stack_id。折叠后的调用栈会被追加到字典中；没有 fold_pattern 时不做任何折叠。
+
+        :param normalizer: 帧名规范化，None 表示不折叠。
+        """
+        folded_ids = np.arange(len(self.stacks), dtype=np.int64)
+        if normalizer is None or normalizer.fold_pattern is None:
+            return folded_ids
+        lines = self.frames.lines
+        for stack_id in range(len(folded_ids)):
+            stack = self.stacks[stack_id]
+            depth = len(normalizer.stack_labels([lines[frame_id] for frame_id in stack]))
+            if depth < len(stack):
+                folded_ids[stack_id] = self.intern(stack[:depth])
+        return folded_ids
+
+    def call_stacks(self) -> np.ndarray:
+        """每个唯一调用栈对应的 call_stack 帧行列表 (object 数组，下标即 stack_id)。"""
+        lines = self.frames.lines
+        return object_array(
+            [[lines[frame_id] for frame_id in stack] for stack in self.stacks]
+        )
+
+    def function_call_stacks(self) -> np.ndarray:
+        """每个唯一调用栈不含地址和模块的调用链，例如 "main+0x2fb;run_builtin+0x70"。"""
+        symbols = self.frames.parsed()["symbol"]
+        return object_array(
+            [";".join([symbols[frame_id] for frame_id in stack]) for stack in self.stacks]
+        )
+
+    def execution_modes(self, kernel_boundary="auto") -> np.ndarray:
+        """每个唯一调用栈的执行模式 (kernel 0, user 1)，由栈顶帧的地址判断，空调用栈视为用户态。
+
+        :param kernel_boundary: 见 kernel_address_mask。
+        """
+        kernel_frames = kernel_address_mask(
+            self.frames.parsed()["address"], kernel_boundary
+        )
+        top_frames = np.fromiter(
+            (stack[-1] if stack else -1 for stack in self.stacks),
+            dtype=np.int64,
+            count=len(self.stacks),
+        )
+        kernel_stacks = np.zeros(len(self.stacks), dtype=bool)
+        has_frames = top_frames >= 0
+        kernel_stacks[has_frames] = kernel_frames[top_frames[has_frames]]
+        return np.where(kernel_stacks, 0, 1)
+
+    def to_arrays(self) -> dict:
+        """以列式数组表示帧字典和调用栈字典 (调用栈使用 CSR 形式：偏移数组 + 帧 id 数组)。"""
+        frame_data, frame_offsets = encode_strings(self.frames.lines)
+        stack_offsets = np.zeros(len(self.stacks) + 1, dtype=np.int64)
+        np.cumsum([len(stack) for stack in self.stacks], out=stack_offsets[1:])
+        stack_frames = np.fromiter(
+            (frame_id for stack in self.stacks for frame_id in stack),
+            dtype=np.int32,
+            count=int(stack_offsets[-1]),
+        )
+        return {
+            "frame_data": frame_data,
+            "frame_offsets": frame_offsets,
+            "stack_frames": stack_frames,
+            "stack_offsets": stack_offsets,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: dict) -> "StackTable":
+        """to_arrays 的逆操作。"""
+        stack_table = cls()
+        for line in decode_strings(arrays["frame_data"], arrays["frame_offsets"]):
+            stack_table.frames.intern(line)
+        stack_frames = np.asarray(arrays["stack_frames"]).tolist()
+        stack_offsets = np.asarray(arrays["stack_offsets"]).tolist()
+        for begin, end in zip(stack_offsets[:-1], stack_offsets[1:]):
+            stack_table.intern(tuple(stack_frames[begin:end]))
+        return stack_table
+
+    @staticmethod
+    def take(values, stack_ids) -> np.ndarray:
+        """把按 stack_id 计算好的值广播到每一行。
+
+        :param values: 下标为 stack_id 的序列，长度等于唯一调用栈的个数。
+        :param stack_ids: 每一行的 stack_id。
+        :return: 与 stack_ids 等长的数组。
+        """
+        if not isinstance(values, np.ndarray):
+            values = object_array(values)
+        return values.take(np.asarray(stack_ids, dtype=np.intp))
+
+
+class StackTrie:
+    """调用栈前缀树。
+
+    对唯一调用栈只建一次：bottom up (direction 0) 从栈底开始插入，top down (direction 1) 从栈顶开始插入，
+    帧按 "符号+偏移 (模块)" 比较。截断到任意深度后的调用栈 key 就是该深度上的节点 id，
+    因此对任意 degrees_of_freedom 的查询都只需 O(唯一调用栈数)。
+    """
+
+    def __init__(
+        self, call_stacks, direction: int = 0, normalizer: FrameNormalizer = None
+    ) -> None:
+        """
+        :param call_stacks: 每个唯一调用栈的帧行列表 (栈底在前)。
+        :param direction: bottom up 0 / top down 1。
+        :param normalizer: 帧名规范化，默认保留 "符号+偏移 (模块)"。
+        """
+        self.direction = direction
+        self.labels = [""]  # node -> frame key
+        self.parents = [-1]  # node -> parent node
+        children = {}  # (parent node, frame key) -> node
+        normalizer = normalizer if normalizer is not None else FrameNormalizer()
+        lengths = np.zeros(len(call_stacks), dtype=np.int64)
+        path = []  # 每个调用栈依次经过的节点 (CSR)
+        for i, call_stack in enumerate(call_stacks):
+            frame_keys = normalizer.stack_labels(call_stack)
+            if direction != 0:
+                frame_keys.reverse()
+            node = 0
+            for frame_key in frame_keys:
+                child = children.get((node, frame_key))
+                if child is None:
+                    child = children[(node, frame_key)] = len(self.labels)
+                    self.labels.append(frame_key)
+                    self.parents.append(node)
+                node = child
+                path.append(node)
+            lengths[i] = len(frame_keys)
+        self.lengths = lengths
+        self.offsets = np.zeros(len(call_stacks) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.path = np.array(path, dtype=np.int64)
+        self._keys = {0: ""}
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def node_ids(self, depth: int) -> np.ndarray:
+        """每个调用栈截断到 depth 层后对应的节点 id (depth 为 -1 表示整个调用栈)，可直接作为 key id。"""
+        if depth < -1:
+            # 与 get_user_defined_indentical_call_stacks 一致，只有 -1 表示整个调用栈
+            raise ValueError(f"invalid degrees_of_freedom {depth}")
+        depths = self.lengths if depth == -1 else np.minimum(self.lengths, depth)
+        node_ids = np.zeros(len(self.lengths), dtype=np.int64)
+        has_frames = depths > 0
+        node_ids[has_frames] = self.path[self.offsets[:-1][has_frames] + depths[has_frames] - 1]
+        return node_ids
+
+    def key(self, node: int) -> str:
+        """节点对应的调用链，帧的顺序总是栈底在前，与 get_user_defined_indentical_call_stacks 相同。"""
+        chain = []
+        ancestor = node
+        while ancestor not in self._keys:
+            chain.append(ancestor)
+            ancestor = self.parents[ancestor]
+        for each in reversed(chain):
+            parent = self.parents[each]
+            parent_key = self._keys[parent]
+            if parent == 0:
+                self._keys[each] = self.labels[each]
+            elif self.direction == 0:
+                self._keys[each] = parent_key + ";" + self.labels[each]
+            else:
+                self._keys[each] = self.labels[each] + ";" + parent_key
+        return self._keys[node]
+
+    def keys(self, node_ids) -> np.ndarray:
+        return object_array([self.key(node) for node in node_ids])
@@ -0,0 +1,165 @@
+"""Tests of the filtering functions: equivalence with the original implementations and CICP tables.
+
+Run with: python -m pytest -q
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from filtering import (
+    build_cicp_table,
+    divide_TOCC,
+    divide_TOCC_optimized,
+    divide_TOCC_sweep,
+    filtering_operation,
+    identify_consecutive_identical_call_stacks_vectorized,
+    subtocc_views,
+)
+from stacks import INTERRUPT_FRAME_PATTERN, FrameNormalizer
+from timing import DataPreparation
+
+
+def _intervals(seed: int, length: int, integer: bool = True) -> pd.DataFrame:
+    """随机 CICP 区间。integer 为 True 时取值在小范围整数上，会出现首尾相接、完全相同和零长度的区间。"""
+    rng = np.random.default_rng(seed)
+    if integer:
+        ts_begin = rng.integers(0, 60, length).astype(np.float64)
+        ts_end = ts_begin + rng.integers(0, 8, length)
+    else:
+        ts_begin = rng.uniform(0, 100, length)
+        ts_end = ts_begin + rng.uniform(0.01, 5, length)
+    df = pd.DataFrame(
+        {"tid": np.arange(length), "ts_begin": ts_begin, "ts_end": ts_end}
+    )
+    # 打乱行的顺序和索引标签
+    return df.iloc[rng.permutation(length)].set_axis(rng.permutation(length) * 3)
+
+
+def _assert_same_toccs(expected: list, actual: list) -> None:
+    assert len(expected) == len(actual)
+    for expected_df, actual_df in zip(expected, actual):
+        pd.testing.assert_frame_equal(expected_df, actual_df)
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_divide_TOCC_sweep_matches_divide_TOCC(seed):
+    df = _intervals(seed, 40)
+    _assert_same_toccs(divide_TOCC(df), divide_TOCC_sweep(df))
+
+
+def test_divide_TOCC_sweep_touching_and_identical_intervals():
+    df = pd.DataFrame(
+        {
+            "tid": [1, 2, 3, 4, 5, 6, 7, 8],
+            "ts_begin": [0.0, 2.0, 2.0, 10.0, 10.0, 20.0, 25.0, 30.0],
+            "ts_end": [2.0, 4.0, 4.0, 12.0, 12.0, 25.0, 25.0, 30.0],
+        }
+    )
+    toccs = divide_TOCC_sweep(df)
+    _assert_same_toccs(divide_TOCC(df), toccs)
+    # 首尾相接的 [0, 2] 和 [2, 4] 合并；两个完全相同的区间只有一个不同的 ts_begin，不构成 TOCC
+    assert [tocc["tid"].tolist() for tocc in toccs] == [[1, 2, 3], [6, 7]]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_divide_TOCC_sweep_matches_divide_TOCC_optimized(seed):
+    # divide_TOCC_optimized 不把首尾相接的区间算作重叠，这里使用不会相接的随机实数区间
+    df = _intervals(seed, 200, integer=False)
+    _assert_same_toccs(divide_TOCC_optimized(df), divide_TOCC_sweep(df))
+
+
+def test_divide_TOCC_sweep_small_inputs():
+    empty = pd.DataFrame({"tid": [], "ts_begin": [], "ts_end": []})
+    assert divide_TOCC_sweep(empty) == []
+    single = pd.DataFrame({"tid": [1], "ts_begin": [1.0], "ts_end": [2.0]})
+    assert divide_TOCC_sweep(single) == divide_TOCC(single) == []
+
+
+USER_FRAMES = [
+    "401500 spin_lock+0x5 (/opt/app)",
+    "401200 worker+0x20 (/opt/app)",
+    "401000 main+0x10 (/opt/app)",
+]
+INTERRUPT_FRAMES = [
+    "ffffffffad12a400 sysvec_apic_timer_interrupt+0x3 ([kernel.kallsyms])",
+    "ffffffffabc01b1a asm_sysvec_apic_timer_interrupt+0x1a ([kernel.kallsyms])",
+]
+
+
+def _interrupted_spin_trace(path, always_interrupted: bool = False) -> str:
+    """
+    两个线程在用户态自旋 90 个样本，第一个样本以及之后每 10 个样本被时钟中断打断 (perf script 格式，栈顶在前)。
+    always_interrupted 为 True 时再加一个线程 103，它的每个样本都被打断，折叠后的调用栈从不单独出现。
+    """
+    threads = {101: USER_FRAMES, 102: USER_FRAMES}
+    if always_interrupted:
+        threads[103] = ["401700 other_lock+0x9 (/opt/app)"] + USER_FRAMES[1:]
+    lines = []
+    for i in range(90):
+        for tid, user_frames in threads.items():
+            timestamp = 100 + i * 0.001 + tid * 1e-6
+            lines.append(f"app {tid} [000] {timestamp:.6f}: 1000 cpu-clock:pppH:")
+            interrupted = i % 10 == 0 or tid == 103
+            frames = (INTERRUPT_FRAMES if interrupted else []) + user_frames
+            lines += ["\t" + frame for frame in frames]
+            lines.append("")
+    path.write_text("\n".join(lines) + "\n")
+    return str(path)
+
+
+@pytest.mark.parametrize("fused", [False, True])
+def test_interrupted_first_sample_keeps_user_mode(tmp_path, fused):
+    input_file_path = _interrupted_spin_trace(tmp_path / "perf.txt")
+    normalizer = FrameNormalizer("none", INTERRUPT_FRAME_PATTERN)
+    data_preparation = DataPreparation(normalizer=normalizer)
+    if fused:
+        records_df = data_preparation.data_loading_cicp(input_file_path, -1, 0)
+    else:
+        records_df = identify_consecutive_identical_call_stacks_vectorized(
+            data_preparation.data_processing(data_preparation.data_loading(input_file_path)),
+            -1,
+            0,
+            normalizer=normalizer,
+        )
+    records_df = filtering_operation(records_df)
+    # 每个线程的 90 个样本合并为一个 CICP
+    assert records_df["duration_length"].tolist() == [90, 90]
+    assert (records_df["execution_mode"] == 1).all()
+    assert set(records_df["function_call_stack"]) == {"main+0x10;worker+0x20;spin_lock+0x5"}
+
+    views = subtocc_views(build_cicp_table(records_df, 2))
+    assert [view.execution_mode for view in views] == [1]
+
+
+@pytest.mark.parametrize("mode", ["none", "function"])
+def test_fused_matches_data_processing_for_stacks_only_seen_interrupted(tmp_path, mode):
+    input_file_path = _interrupted_spin_trace(tmp_path / "perf.txt", always_interrupted=True)
+    normalizer = FrameNormalizer(mode, INTERRUPT_FRAME_PATTERN)
+    fused_preparation = DataPreparation(normalizer=normalizer)
+    fused_df = fused_preparation.data_loading_cicp(input_file_path, -1, 0)
+    data_preparation = DataPreparation(normalizer=normalizer)
+    records_df = identify_consecutive_identical_call_stacks_vectorized(
+        data_preparation.data_processing(data_preparation.data_loading(input_file_path)),
+        -1,
+        0,
+        normalizer=normalizer,
+    )
+    columns = [
+        "tid",
+        "ts_begin",
+        "ts_end",
+        "duration_length",
+        "user_defined_indentical_call_stacks",
+        "function_call_stack",
+        "top_function",
+        "execution_mode",
+    ]
+    pd.testing.assert_frame_equal(
+        fused_df[columns].sort_values(["tid", "ts_begin"], ignore_index=True),
+        records_df[columns].sort_values(["tid", "ts_begin"], ignore_index=True),
+        check_dtype=False,
+    )
+    other_lock = fused_df[fused_df["tid"] == 103]
+    assert other_lock["duration_length"].tolist() == [90]
+    assert other_lock["execution_mode"].tolist() == [1]
+    assert other_lock["function_call_stack"].tolist() == ["main+0x10;worker+0x20;other_lock+0x9"]
@@ -1,39 +1,213 @@
+import mmap
+import os
 import re
 
+import numpy as np
 import pandas as pd
+from joblib import Parallel, cpu_count, delayed
+
+from filtering import (
+    SampleFilter,
+    get_user_defined_indentical_call_stacks,
+    identify_consecutive_identical_call_stacks_vectorized,
+)
+from stacks import FrameNormalizer, StackTable
+from trace_format import TraceFile, is_trace_file
+
+# Bump when the parsed representation of a perf script file changes (invalidates cached traces).
+PARSER_VERSION = 1
+# Size of the blocks split into lines at once by the chunk parser.
+PARSE_BLOCK_SIZE = 64 * 1024 * 1024
+# Files smaller than this are parsed in the current process.
+PARALLEL_PARSE_MIN_SIZE = 16 * 1024 * 1024
+
+
+def _function_call_stack(call_stack: list) -> str:
+    """Function call chain without addresses and modules, e.g. "main+0x2fb;run_builtin+0x70"."""
+    return ";".join([" ".join(j.split()[1:-1]) for j in call_stack])
+
+
+def _record_boundary(data, offset: int, limit: int) -> int:
+    """Offset of the first record starting at or after offset (records are separated by a blank line)."""
+    if offset <= 0:
+        return 0
+    position = data.find(b"\n\n", offset - 1, limit)
+    return limit if position == -1 else position + 2
+
+
+def split_perf_script(input_file_path: str, parts: int) -> list:
+    """Split a perf script text file into byte ranges aligned to record boundaries.
+
+    :param input_file_path:
+    :param parts: number of ranges wanted.
+    :return: [(begin, end), ...]
+    """
+    size = os.path.getsize(input_file_path)
+    if size == 0:
+        return []
+    with open(input_file_path, "rb") as input_file, mmap.mmap(
+        input_file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as data:
+        boundaries = [0]
+        for i in range(1, parts):
+            boundary = _record_boundary(data, size * i // parts, size)
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+    if boundaries[-1] < size:
+        boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def parse_perf_script_range(
+    input_file_path: str, begin: int, end: int, sample_filter: SampleFilter = None
+) -> dict:
+    """Parse the records of a perf script text file in the byte range [begin, end).
+
+    The range is read through mmap and parsed as bytes, frames, call stacks, commands
+    and events are interned into local dictionaries, so that only compact arrays
+    are sent back to the parent process.
+
+    :param sample_filter: samples rejected by the filter are skipped at their header line,
+        their frames are never interned.
+
+    :return: {"timestamp", "tid", "cpu", "command", "event", "stack_id": arrays,
+              "commands", "events", "frames": lists of str, "stacks": list of tuples of frame ids}
+    """
+    frame_index, stack_index, command_index, event_index = {}, {}, {}, {}
+    timestamps, tids, cpus, command_ids, event_ids, stack_ids = [], [], [], [], [], []
+    call_stack = []  # temp call stacks
+    header = None
+    with open(input_file_path, "rb") as input_file, mmap.mmap(
+        input_file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as data:
+        position = begin
+        while position < end:
+            block_end = min(
+                end, _record_boundary(data, position + PARSE_BLOCK_SIZE, end)
+            )
+            lines = data[position:block_end].split(b"\n")
+            if lines[-1] == b"":
+                lines.pop()
+            position = block_end
+            for each_line in lines:
+                if not each_line:
+                    if header is not None:
+                        call_stack.reverse()
+                        timestamp, command, tid, cpu, event = header
+                        stack_id = stack_index.setdefault(
+                            tuple(call_stack), len(stack_index)
+                        )
+                        timestamps.append(float(timestamp))
+                        command_ids.append(
+                            command_index.setdefault(command, len(command_index))
+                        )
+                        tids.append(int(tid.rpartition(b"/")[2]))
+                        cpus.append(int(cpu) if cpu else -1)
+                        event_ids.append(event_index.setdefault(event, len(event_index)))
+                        stack_ids.append(stack_id)
+                    call_stack = []
+                    header = None
+                elif each_line[0] == 35:  # "#"
+                    continue
+                elif each_line[0] == 9:  # "\t"
+                    if header is not None:
+                        frame = each_line.replace(b"\t", b"")
+                        call_stack.append(
+                            frame_index.setdefault(frame, len(frame_index))
+                        )
+                else:
+                    # Same layouts as DataPreparation.iter_perf_records
+                    position_flag = each_line.rfind(b"[")
+                    if position_flag != -1:
+                        fields = each_line[: position_flag - 1].split()
+                        command = b" ".join(fields[:-1])
+                        tid = fields[-1]
+                        fields = (
+                            each_line[position_flag:]
+                            .replace(b":", b"")
+                            .replace(b"[", b"")
+                            .replace(b"]", b"")
+                            .split()
+                        )
+                        header = (fields[1], command, tid, fields[0], fields[2])
+                    else:
+                        fields = each_line.strip().split()
+                        command = b"".join(fields[:-4])
+                        header = (fields[-3], command, fields[-4], b"", fields[-1])
+                    if sample_filter is not None:
+                        timestamp, command, tid, _, event = header
+                        pid, _, tid = tid.rpartition(b"/")
+                        if not sample_filter.accepts(
+                            timestamp, command, tid, event, pid or None
+                        ):
+                            header = None
+
+    def decode(index: dict) -> list:
+        return [key.decode("utf-8", "replace") for key in index]
+
+    return {
+        "timestamp": np.array(timestamps, dtype=np.float64),
+        "tid": np.array(tids, dtype=np.int64),
+        "cpu": np.array(cpus, dtype=np.int64),
+        "command": np.array(command_ids, dtype=np.int32),
+        "event": np.array(event_ids, dtype=np.int32),
+        "stack_id": np.array(stack_ids, dtype=np.int32),
+        "commands": decode(command_index),
+        "events": decode(event_index),
+        "frames": decode(frame_index),
+        "stacks": list(stack_index),
+    }
 
 
 class DataPreparation:
     """Handle performance data such as function call stacks collected by Linux perf."""
 
-    def __init__(self) -> None:
-        pass
+    def __init__(
+        self,
+        kernel_boundary="auto",
+        sample_filter: SampleFilter = None,
+        normalizer: FrameNormalizer = None,
+    ) -> None:
+        """
+        :param kernel_boundary: start of the kernel address space used to tell kernel mode
+            from user mode, "auto", a preset of stacks.KERNEL_BOUNDARIES or an address.
+        :param sample_filter: predicates applied while loading, see filtering.SampleFilter.
+        :param normalizer: frame normalization used for the CICP keys; when it folds frames
+            (fold_pattern), the derived columns (call_stack, function_call_stack, top_function,
+            execution_mode) describe the folded stack.
+        """
+        self.stack_table = StackTable()
+        self.kernel_boundary = kernel_boundary
+        self.sample_filter = sample_filter
+        self.normalizer = normalizer
 
-    def data_loading(self, input_file_path: str) -> pd.DataFrame:
-        """Loading data.
+    def iter_perf_records(
+        self, input_file_path: str, sample_filter: SampleFilter = None
+    ):
+        """Iterate over the samples of a perf script text file.
 
-        :param file_path:
-        :return:
+        :param input_file_path:
+        :param sample_filter: samples rejected by the filter are skipped at their header line.
+        :return: generator of (timestamp, command, tid, cpu, event, call_stack),
+                 the call stack is ordered from the bottom of the stack to the top.
         """
-
-        top_message = []
-        perf_records = []
         call_stack = []  # temp call stacks
         command, timestamp, event_value, event, cpu, tid = "", "", "", "", "", ""
+        rejected = False
         with open(input_file_path, "r") as input_file:
-            perf_file = input_file.readlines()
-            for each_line in perf_file:
+            for each_line in input_file:
                 if each_line[0] == "#":
-                    top_message.append(each_line)
+                    continue
                 elif each_line[0] == "\t":
-                    call_stack.append(each_line.replace("\t", "").replace("\n", ""))
+                    if not rejected:
+                        call_stack.append(each_line.replace("\t", "").replace("\n", ""))
                 elif each_line[0] == "\n":
-                    call_stack.reverse()
-                    perf_records.append(
-                        (timestamp, command, tid, cpu, event, call_stack)
-                    )
+                    if not rejected:
+                        call_stack.reverse()
+                        yield (timestamp, command, tid, cpu, event, call_stack)
                     call_stack = []
                     command, timestamp, event, cpu, tid = "", "", "", "", ""
+                    rejected = False
                 else:
                     # Note: different versions of perf and different parameters collect different types of data
                     # swapper     0 [000] 691089.368816:     250000 cpu-clock:pppH:
@@ -61,11 +235,232 @@ class DataPreparation:
                         event = tmp_perf_record[-1]
                         tid = tmp_perf_record[-4]
                         command = "".join(str(x) for x in tmp_perf_record[:-4])
+                    # perf script -F pid,tid prints "pid/tid"
+                    pid, _, tid = tid.rpartition("/")
+                    if sample_filter is not None:
+                        rejected = not sample_filter.accepts(
+                            timestamp, command, tid, event, pid or None
+                        )
+
+    def data_loading(self, input_file_path: str) -> pd.DataFrame:
+        """Loading data.
+
+        :param file_path: perf script text or TCSA trace file.
+        :return:
+        """
+        if is_trace_file(input_file_path):
+            return self.data_loading_trace(input_file_path)
+        # Each sample only carries the id of its call stack in self.stack_table.
+        intern_call_stack = self.stack_table.intern_lines
+        perf_records = [
+            (timestamp, command, tid, cpu, event, intern_call_stack(call_stack))
+            for timestamp, command, tid, cpu, event, call_stack in self.iter_perf_records(
+                input_file_path, self.sample_filter
+            )
+        ]
         # Transform DataFrame
-        title_columns = ["timestamp", "command", "tid", "cpu", "event", "call_stack"]
+        title_columns = ["timestamp", "command", "tid", "cpu", "event", "stack_id"]
         perf_records_df = pd.DataFrame(perf_records, columns=title_columns)
+        perf_records_df["stack_id"] = perf_records_df["stack_id"].astype("int32")
         return perf_records_df
 
+    def data_loading_parallel(
+        self, input_file_path: str, n_jobs: int = -1
+    ) -> pd.DataFrame:
+        """
+        [并行版] 通过 mmap 把 perf script 文件按记录边界 (空行) 切分为多个字节区间，
+        在进程池中直接对 bytes 解析，再把各区间的局部帧字典 / 调用栈字典合并到 self.stack_table。
+        输出与 data_loading 相同。
+
+        :param input_file_path: perf script 输出的文本文件路径。
+        :param n_jobs: 使用的进程数，-1 代表使用所有核心。
+        :return: ['timestamp', 'command', 'tid', 'cpu', 'event', 'stack_id']
+        """
+        if is_trace_file(input_file_path):
+            return self.data_loading_trace(input_file_path)
+        n_jobs = cpu_count() if n_jobs == -1 else max(1, n_jobs)
+        if n_jobs == 1 or os.path.getsize(input_file_path) < PARALLEL_PARSE_MIN_SIZE:
+            ranges = split_perf_script(input_file_path, 1)
+            parts = [
+                parse_perf_script_range(input_file_path, *each, self.sample_filter)
+                for each in ranges
+            ]
+        else:
+            # 区间数多于进程数，使各进程的负载更均衡
+            ranges = split_perf_script(input_file_path, n_jobs * 4)
+            parts = Parallel(n_jobs=n_jobs)(
+                delayed(parse_perf_script_range)(
+                    input_file_path, *each, self.sample_filter
+                )
+                for each in ranges
+            )
+
+        # 合并：把各区间的局部 id 重新映射到全局字典
+        stack_table = self.stack_table
+        columns = {
+            "timestamp": [],
+            "command": [],
+            "tid": [],
+            "cpu": [],
+            "event": [],
+            "stack_id": [],
+        }
+        for part in parts:
+            frame_ids = [stack_table.frames.intern(line) for line in part["frames"]]
+            stack_ids = np.array(
+                [
+                    stack_table.intern(tuple([frame_ids[i] for i in stack]))
+                    for stack in part["stacks"]
+                ],
+                dtype=np.int32,
+            )
+            columns["timestamp"].append(part["timestamp"])
+            columns["command"].append(
+                StackTable.take(part["commands"], part["command"])
+            )
+            columns["tid"].append(part["tid"])
+            columns["cpu"].append(part["cpu"])
+            columns["event"].append(StackTable.take(part["events"], part["event"]))
+            columns["stack_id"].append(stack_ids.take(part["stack_id"]))
+
+        if not parts:
+            return pd.DataFrame(columns=list(columns))
+        perf_records_df = pd.DataFrame(
+            {column: np.concatenate(values) for column, values in columns.items()}
+        )
+        return perf_records_df
+
+    def data_loading_trace(self, input_file_path: str) -> pd.DataFrame:
+        """
+        读取 TCSA trace 文件 (见 trace_format.py)，样本数组通过 mmap 零拷贝映射，
+        帧字典 / 调用栈字典替换 self.stack_table。
+
+        :param input_file_path: TCSA trace 文件路径。
+        :return: ['timestamp', 'command', 'tid', 'cpu', 'event', 'stack_id']
+        """
+        trace = TraceFile(input_file_path)
+        self.stack_table = trace.stack_table()
+        perf_records_df = trace.samples()
+        if self.sample_filter is not None and self.sample_filter.active:
+            perf_records_df = perf_records_df[
+                self.sample_filter.mask(perf_records_df)
+            ].reset_index(drop=True)
+        return perf_records_df
+
+    def data_loading_cicp(
+        self,
+        input_file_path: str,
+        degrees_of_freedom: int = -1,
+        direction: int = 0,
+        normalizer: FrameNormalizer = None,
+    ) -> pd.DataFrame:
+        """
+        [融合版] 边解析 perf script 文本边做游程编码，直接输出 CICP。
+
+        每个 tid 只保留一个“未关闭”的游程，当该线程的下一个样本的调用栈 key 发生变化时，
+        关闭游程并输出一行 CICP。逐样本的 DataFrame 从不生成，峰值内存与游程数量成正比，
+        而不是与样本数量成正比。结果与
+        data_loading -> data_processing -> identify_consecutive_identical_call_stacks 的输出列兼容。
+        self.sample_filter 的样本谓词在解析时生效，样本数少于其 min_run_length 的游程在关闭时直接丢弃。
+
+        :param input_file_path: perf script 输出的文本文件路径。
+        :param degrees_of_freedom: 识别连续相同调用栈时使用的层数，-1 表示整个调用栈。
+        :param direction: bottom up 0 / top down 1。
+        :param normalizer: 帧名规范化 (stacks.FrameNormalizer)，None 表示使用 self.normalizer。
+        :return: 以 CICP 为单位的 DataFrame。
+        """
+        if normalizer is None:
+            normalizer = self.normalizer
+        sample_filter = self.sample_filter
+        min_run_length = 1 if sample_filter is None else sample_filter.min_run_length
+        if is_trace_file(input_file_path):
+            # trace 文件已经是列式数组，直接在样本数组上识别 CICP
+            perf_records_df = self.data_processing(
+                self.data_loading_trace(input_file_path), normalizer
+            )
+            records_df = identify_consecutive_identical_call_stacks_vectorized(
+                perf_records_df, degrees_of_freedom, direction, normalizer=normalizer
+            )
+            return records_df[records_df.duration_length >= min_run_length].reset_index(
+                drop=True
+            )
+
+        stack_table = self.stack_table
+        lines = stack_table.frames.lines
+        stack_keys = []  # stack_id -> user defined identical call stack
+        open_runs = {}  # tid -> [tid, stack_id, key, command, event, ts_begin, ts_end, length]
+        runs = []
+
+        for timestamp, command, tid, cpu, event, call_stack in self.iter_perf_records(
+            input_file_path, sample_filter
+        ):
+            stack_id = stack_table.intern_lines(call_stack)
+            while len(stack_keys) < len(stack_table):
+                # 每个唯一调用栈只计算一次 key
+                stack = stack_table.stacks[len(stack_keys)]
+                stack_keys.append(
+                    get_user_defined_indentical_call_stacks(
+                        [lines[frame_id] for frame_id in stack],
+                        degrees_of_freedom,
+                        direction,
+                        normalizer,
+                    )
+                )
+            key = stack_keys[stack_id]
+            timestamp = float(timestamp)
+
+            run = open_runs.get(tid)
+            if run is not None and run[2] == key:
+                run[6] = timestamp
+                run[7] += 1
+            else:
+                if run is not None and run[7] >= min_run_length:
+                    runs.append(run)
+                open_runs[tid] = [
+                    tid,
+                    stack_id,
+                    key,
+                    command,
+                    event,
+                    timestamp,
+                    timestamp,
+                    1,
+                ]
+        runs.extend(run for run in open_runs.values() if run[7] >= min_run_length)
+
+        title_columns = [
+            "tid",
+            "stack_id",
+            "user_defined_indentical_call_stacks",
+            "command",
+            "event",
+            "ts_begin",
+            "ts_end",
+            "duration_length",
+        ]
+        records_df = pd.DataFrame(runs, columns=title_columns)
+        records_df["tid"] = records_df["tid"].astype(int)
+        records_df["stack_id"] = records_df["stack_id"].astype("int32")
+        records_df = records_df.sort_values(by=["tid", "ts_begin"], ignore_index=True)
+
+        # 按唯一调用栈计算派生列，再广播到每个 CICP；折叠中断帧时按折叠后的调用栈计算。
+        # folded_stack_ids 可能追加只出现在折叠中的调用栈，它们没有 stack_keys，
+        # top_function 按原来的 stack_id 从 key (已经是折叠后的 key) 取得。
+        raw_stack_ids = records_df["stack_id"].to_numpy()
+        stack_ids = stack_table.folded_stack_ids(normalizer)[raw_stack_ids]
+        call_stacks = stack_table.call_stacks()
+        records_df["call_stack"] = stack_table.take(call_stacks, stack_ids)
+        records_df["function_call_stack"] = stack_table.take(
+            stack_table.function_call_stacks(), stack_ids
+        )
+        records_df["top_function"] = stack_table.take(
+            [key.split(";")[-1] for key in stack_keys], raw_stack_ids
+        )
+        records_df["execution_mode"] = stack_table.take(
+            stack_table.execution_modes(self.kernel_boundary), stack_ids
+        ).astype(int)
+        return records_df
+
     def data_loading_optimized(self, input_file_path: str) -> pd.DataFrame:
         """
         [优化版] 使用生成器和正则表达式以流式方式高效加载数据。
@@ -140,17 +535,45 @@ class DataPreparation:
 
         return perf_records_df
 
-    def data_processing(self, perf_records_df: pd.DataFrame) -> pd.DataFrame:
-        # DataFrame -> ['timestamp', 'command', 'tid', 'cpu', 'event', 'call_stack']
+    def data_processing(
+        self, perf_records_df: pd.DataFrame, normalizer: FrameNormalizer = None
+    ) -> pd.DataFrame:
+        """
+        :param perf_records_df: data_loading 的输出。
+        :param normalizer: 折叠帧时派生列按折叠后的调用栈计算，None 表示使用 self.normalizer。
+        """
+        # DataFrame -> ['timestamp', 'command', 'tid', 'cpu', 'event', 'stack_id']
         perf_records_df["tid"] = perf_records_df["tid"].astype(int)
         perf_records_df["cpu"] = perf_records_df["cpu"].astype(int)
         perf_records_df["timestamp"] = perf_records_df["timestamp"].astype(float)
+        if "stack_id" in perf_records_df.columns:
+            # Derived columns are computed once per unique call stack and broadcast to the samples.
+            # With a fold pattern they describe the folded stack, so a sample interrupted by an
+            # interrupt keeps the mode and frames of the code it interrupted.
+            stack_table = self.stack_table
+            stack_ids = stack_table.folded_stack_ids(
+                normalizer if normalizer is not None else self.normalizer
+            )[perf_records_df["stack_id"].to_numpy()]
+            call_stacks = stack_table.call_stacks()
+            perf_records_df["call_stack"] = stack_table.take(call_stacks, stack_ids)
+            perf_records_df["top_function"] = stack_table.take(
+                [str(x[0]) if len(x) > 0 else str([]) for x in call_stacks], stack_ids
+            )
+            perf_records_df["function_call_stack"] = stack_table.take(
+                stack_table.function_call_stacks(), stack_ids
+            )
+            perf_records_df["execution_mode"] = stack_table.take(
+                stack_table.execution_modes(self.kernel_boundary), stack_ids
+            ).astype(int)
+            return perf_records_df
+
+        # DataFrame -> ['timestamp', 'command', 'tid', 'cpu', 'event', 'call_stack']
         perf_records_df["top_function"] = perf_records_df.apply(
             lambda x: x.call_stack[0] if len(x.call_stack) > 0 else [], axis=1
         )
         perf_records_df["top_function"] = perf_records_df["top_function"].astype(str)
         perf_records_df["function_call_stack"] = perf_records_df["call_stack"].apply(
-            lambda x: ";".join([" ".join(j.split()[1:-1]) for j in x])
+            _function_call_stack
         )
         perf_records_df["function_call_stack"] = perf_records_df[
             "function_call_stack"
@@ -0,0 +1,98 @@
+import hashlib
+import os
+
+import pandas as pd
+
+from filtering import SampleFilter
+from timing import PARSER_VERSION, DataPreparation
+from trace_format import TraceFile, write_trace
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "tcsa")
+DEFAULT_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+# Number of leading bytes of the input file included in the fingerprint.
+HASH_PREFIX_SIZE = 4 * 1024 * 1024
+
+
+class TraceCache:
+    """解析结果的磁盘缓存。
+
+    以 (文件大小, mtime, 文件开头部分内容的哈希, 解析器版本, 下推到解析器中的样本谓词) 作为 key，
+    把 data_processing 之后的结果以列式数组 (帧字典 / 调用栈字典 + 样本数组) 保存为一个 TCSA trace 文件，
+    只修改 direction、degrees_of_freedom、threshold 等参数时可以跳过文本解析。
+    缓存目录的总大小超过 max_size 时，按最近使用时间淘汰旧的条目 (LRU)。
+    """
+
+    def __init__(
+        self, cache_dir: str = DEFAULT_CACHE_DIR, max_size: int = DEFAULT_CACHE_SIZE
+    ) -> None:
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def fingerprint(
+        self, input_file_path: str, sample_filter: SampleFilter = None
+    ) -> str:
+        stat = os.stat(input_file_path)
+        content_hash = hashlib.sha1()
+        with open(input_file_path, "rb") as input_file:
+            content_hash.update(input_file.read(HASH_PREFIX_SIZE))
+        key = f"{stat.st_size}:{stat.st_mtime_ns}:{content_hash.hexdigest()}:{PARSER_VERSION}"
+        if sample_filter is not None and sample_filter.active:
+            key += f":{sample_filter.key()}"
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _entry_path(
+        self, input_file_path: str, data_preparation: DataPreparation
+    ) -> str:
+        fingerprint = self.fingerprint(input_file_path, data_preparation.sample_filter)
+        return os.path.join(self.cache_dir, fingerprint + ".tcsa")
+
+    def load(
+        self, input_file_path: str, data_preparation: DataPreparation
+    ) -> pd.DataFrame:
+        """读取缓存的解析结果。
+
+        :param input_file_path: perf script 输出的文本文件路径。
+        :param data_preparation: 命中时其 stack_table 会被替换为缓存中的调用栈字典。
+        :return: 与 data_processing 输出相同的 DataFrame，未命中时返回 None。
+        """
+        entry_path = self._entry_path(input_file_path, data_preparation)
+        try:
+            trace = TraceFile(entry_path)
+        except (OSError, ValueError):
+            return None
+        os.utime(entry_path)  # 记录最近一次使用的时间，用于 LRU 淘汰
+
+        data_preparation.stack_table = trace.stack_table()
+        return data_preparation.data_processing(trace.samples())
+
+    def store(
+        self,
+        input_file_path: str,
+        data_preparation: DataPreparation,
+        perf_records_df: pd.DataFrame,
+    ) -> None:
+        """以 TCSA trace 格式保存 data_processing 的结果 (只保存样本数组和字典，派生列在读取时重新广播)。"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # write_trace 先写临时文件再原子替换，避免并发运行时读到写了一半的缓存
+        write_trace(
+            self._entry_path(input_file_path, data_preparation),
+            data_preparation.stack_table,
+            perf_records_df,
+        )
+        self.evict()
+
+    def evict(self) -> None:
+        """缓存目录超过 max_size 时，删除最久未使用的条目。"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".tcsa"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            os.remove(path)
+            total_size -= size
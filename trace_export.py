@@ -0,0 +1,122 @@
+"""Export of CICPs as Chrome Trace Event Format JSON (chrome://tracing, Perfetto UI).
+
+Layout of the exported trace:
+
+    process    one per command (pid = index of the command), named by the command
+    thread     one track per tid, named "<command> <tid>"
+    slice      one complete event ("ph": "X") per CICP, from ts_begin to ts_end,
+               named by its call stack key (user_defined_indentical_call_stacks, i.e. the
+               stack after direction / degrees_of_freedom / normalization),
+               category "kernel" or "user", args: tocc_id, subtocc_id, samples
+    instant    global instant events ("ph": "i", "s": "g") at the first ts_begin and the
+               last ts_end of every TOCC
+
+Timestamps are perf timestamps converted to microseconds. Events are formatted and written
+in chunks, the JSON text of the whole trace is never held in memory.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Number of CICPs formatted per write.
+CHUNK_SIZE = 100000
+EXECUTION_MODE_NAMES = {0: "kernel", 1: "user"}
+
+
+def _json_strings(values) -> list:
+    """JSON-encode each distinct string once."""
+    return [json.dumps(str(value)) for value in values]
+
+
+def _tocc_instant_events(df: pd.DataFrame) -> list:
+    if "tocc_id" not in df.columns:
+        return []
+    in_tocc = df[df["tocc_id"] >= 0]
+    bounds = in_tocc.groupby("tocc_id").agg(
+        ts_begin=("ts_begin", "min"), ts_end=("ts_end", "max")
+    )
+    events = []
+    for tocc_id, ts_begin, ts_end in zip(bounds.index, bounds["ts_begin"], bounds["ts_end"]):
+        for name, ts in ((f"TOCC {tocc_id} begin", ts_begin), (f"TOCC {tocc_id} end", ts_end)):
+            events.append(
+                f'{{"name":"{name}","ph":"i","s":"g","ts":{ts * 1e6:.3f},"pid":0,"tid":0}}'
+            )
+    return events
+
+
+def write_trace_events(output_file: str, df: pd.DataFrame, chunk_size: int = CHUNK_SIZE) -> int:
+    """把 CICP 表 (build_cicp_table 的结果，或 TOCCView.frame() 得到的单个组) 写为 Trace Event JSON。
+
+    先写临时文件再重命名；CICP 按 chunk_size 分块格式化和写出。
+
+    :param output_file: 输出的 .json 文件。
+    :param df: 需要包含 tid、command、ts_begin、ts_end、duration_length、
+        user_defined_indentical_call_stacks 列，可选 execution_mode、tocc_id、subtocc_id。
+    :param chunk_size: 每次格式化和写出的 CICP 数。
+    :return: 写出的事件数。
+    """
+    command_codes, commands = pd.factorize(df["command"])
+    key_codes, keys = pd.factorize(df["user_defined_indentical_call_stacks"])
+    key_names = _json_strings(keys)
+    tids = df["tid"].to_numpy()
+    ts_begin = df["ts_begin"].to_numpy(dtype=np.float64) * 1e6
+    durations = df["ts_end"].to_numpy(dtype=np.float64) * 1e6 - ts_begin
+    samples = df["duration_length"].to_numpy()
+    length = len(df)
+    modes = (
+        df["execution_mode"].to_numpy()
+        if "execution_mode" in df.columns
+        else np.full(length, -1)
+    )
+    tocc_ids = df["tocc_id"].to_numpy() if "tocc_id" in df.columns else np.full(length, -1)
+    subtocc_ids = (
+        df["subtocc_id"].to_numpy() if "subtocc_id" in df.columns else np.full(length, -1)
+    )
+
+    # Metadata events: process names, then one named thread track per (command, tid).
+    events = [
+        f'{{"name":"process_name","ph":"M","pid":{pid},"args":{{"name":{name}}}}}'
+        for pid, name in enumerate(_json_strings(commands))
+    ]
+    tracks = pd.DataFrame({"pid": command_codes, "tid": tids}).drop_duplicates()
+    for pid, tid in zip(tracks["pid"], tracks["tid"]):
+        name = json.dumps(f"{commands[pid]} {tid}")
+        events.append(
+            f'{{"name":"thread_name","ph":"M","pid":{pid},"tid":{tid},"args":{{"name":{name}}}}}'
+        )
+    events += _tocc_instant_events(df)
+
+    tmp_file = f"{output_file}.{os.getpid()}.tmp"
+    count = len(events)
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        f.write('{"displayTimeUnit":"ms","traceEvents":[\n')
+        f.write(",\n".join(events))
+        for start in range(0, length, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            # Python lists index faster than NumPy arrays in the formatting loop.
+            columns = zip(
+                key_codes[chunk].tolist(),
+                modes[chunk].tolist(),
+                ts_begin[chunk].tolist(),
+                durations[chunk].tolist(),
+                command_codes[chunk].tolist(),
+                tids[chunk].tolist(),
+                tocc_ids[chunk].tolist(),
+                subtocc_ids[chunk].tolist(),
+                samples[chunk].tolist(),
+            )
+            lines = [
+                f'{{"name":{key_names[key]},"cat":"{EXECUTION_MODE_NAMES.get(mode, "cicp")}",'
+                f'"ph":"X","ts":{ts:.3f},"dur":{dur:.3f},"pid":{pid},"tid":{tid},'
+                f'"args":{{"tocc_id":{tocc_id},"subtocc_id":{subtocc_id},"samples":{sample_count}}}}}'
+                for key, mode, ts, dur, pid, tid, tocc_id, subtocc_id, sample_count in columns
+            ]
+            if count:
+                f.write(",\n")
+            f.write(",\n".join(lines))
+            count += len(lines)
+        f.write("\n]}\n")
+    os.replace(tmp_file, output_file)
+    return count
@@ -0,0 +1,205 @@
+"""TCSA trace file (.tcsa): a compact columnar format for perf script samples.
+
+Layout (all integers little-endian):
+
+    offset 0   magic      8 bytes  b"TCSATRC\\x01"
+    offset 8   header     uint64   length of the JSON header in bytes
+    offset 16  JSON header (UTF-8):
+               {"version": 1, "samples": N,
+                "arrays": {name: {"dtype": "<i8", "count": n, "offset": byte offset}, ...}}
+    ...        array data, each array starts at a 64-byte aligned offset
+
+Arrays:
+
+    timestamp        int64[N]   sample time in nanoseconds
+    tid, cpu         int32[N]
+    stack_id         int32[N]   index into the stack table
+    command, event   int32[N]   index into the command / event dictionaries
+    command_data, command_offsets, event_data, event_offsets
+                     uint8 UTF-8 bytes + int64[n + 1] offsets of the dictionary strings
+    frame_data, frame_offsets
+                     frame dictionary: one perf script frame line per frame id
+    stack_frames, stack_offsets
+                     stack table in CSR form: the frame ids (bottom of the stack first)
+                     of stack i are stack_frames[stack_offsets[i]:stack_offsets[i + 1]]
+
+Arrays are memory-mapped into NumPy without copying when a trace is loaded.
+
+Usage:
+    python trace_format.py convert <perf_script.txt> <output.tcsa> [--jobs N]
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+import pandas as pd
+
+from stacks import StackTable, decode_strings, encode_strings
+
+MAGIC = b"TCSATRC\x01"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+
+def is_trace_file(input_file_path: str) -> bool:
+    """Whether the file starts with the TCSA trace magic."""
+    try:
+        with open(input_file_path, "rb") as input_file:
+            return input_file.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def write_trace(
+    output_path: str, stack_table: StackTable, perf_records_df: pd.DataFrame
+) -> None:
+    """Write samples (the output of data_loading / data_processing) as a TCSA trace file.
+
+    :param output_path:
+    :param stack_table: the stack table the stack_id column refers to.
+    :param perf_records_df: ['timestamp', 'command', 'tid', 'cpu', 'event', 'stack_id']
+    :return:
+    """
+    command_codes, command_values = pd.factorize(perf_records_df["command"])
+    event_codes, event_values = pd.factorize(perf_records_df["event"])
+    command_data, command_offsets = encode_strings([str(x) for x in command_values])
+    event_data, event_offsets = encode_strings([str(x) for x in event_values])
+    timestamps = perf_records_df["timestamp"].to_numpy(dtype=np.float64)
+
+    arrays = {
+        "timestamp": np.rint(timestamps * 1e9).astype(np.int64),
+        "tid": perf_records_df["tid"].to_numpy(dtype=np.int32),
+        "cpu": perf_records_df["cpu"].to_numpy(dtype=np.int32),
+        "stack_id": perf_records_df["stack_id"].to_numpy(dtype=np.int32),
+        "command": command_codes.astype(np.int32),
+        "event": event_codes.astype(np.int32),
+        "command_data": command_data,
+        "command_offsets": command_offsets,
+        "event_data": event_data,
+        "event_offsets": event_offsets,
+    }
+    arrays.update(stack_table.to_arrays())
+
+    # The header holds the array offsets, so reserve room for it and grow the reservation if needed.
+    descriptions = {
+        name: {"dtype": array.dtype.str, "count": len(array), "offset": 0}
+        for name, array in arrays.items()
+    }
+    reserved = 1024
+    while True:
+        offset = _align(len(MAGIC) + 8 + reserved)
+        for name, array in arrays.items():
+            descriptions[name]["offset"] = offset
+            offset = _align(offset + array.nbytes)
+        header = json.dumps(
+            {
+                "version": FORMAT_VERSION,
+                "samples": len(perf_records_df),
+                "arrays": descriptions,
+            }
+        ).encode("utf-8")
+        if len(header) <= reserved:
+            break
+        reserved *= 2
+
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as output_file:
+        output_file.write(MAGIC)
+        output_file.write(struct.pack("<Q", len(header)))
+        output_file.write(header)
+        for name, array in arrays.items():
+            output_file.seek(descriptions[name]["offset"])
+            output_file.write(np.ascontiguousarray(array).tobytes())
+        output_file.truncate(offset)
+    os.replace(tmp_path, output_path)
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class TraceFile:
+    """A memory-mapped TCSA trace file.
+
+    ``trace.arrays[name]`` are read-only NumPy views of the mapped file (no copy).
+    """
+
+    def __init__(self, input_file_path: str) -> None:
+        self.path = input_file_path
+        with open(input_file_path, "rb") as input_file:
+            self._mmap = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{input_file_path} is not a TCSA trace file")
+        (header_size,) = struct.unpack_from("<Q", self._mmap, len(MAGIC))
+        header_begin = len(MAGIC) + 8
+        header = json.loads(
+            self._mmap[header_begin : header_begin + header_size].decode("utf-8")
+        )
+        if header["version"] > FORMAT_VERSION:
+            raise ValueError(
+                f"{input_file_path}: unsupported TCSA trace version {header['version']}"
+            )
+        self.sample_count = header["samples"]
+        self.arrays = {
+            name: np.frombuffer(
+                self._mmap,
+                dtype=np.dtype(description["dtype"]),
+                count=description["count"],
+                offset=description["offset"],
+            )
+            for name, description in header["arrays"].items()
+        }
+
+    def __len__(self) -> int:
+        return self.sample_count
+
+    def stack_table(self) -> StackTable:
+        return StackTable.from_arrays(self.arrays)
+
+    def commands(self) -> list:
+        return decode_strings(self.arrays["command_data"], self.arrays["command_offsets"])
+
+    def events(self) -> list:
+        return decode_strings(self.arrays["event_data"], self.arrays["event_offsets"])
+
+    def samples(self) -> pd.DataFrame:
+        """Samples in the layout of DataPreparation.data_loading (timestamps in seconds)."""
+        arrays = self.arrays
+        return pd.DataFrame(
+            {
+                "timestamp": arrays["timestamp"] / 1e9,
+                "command": StackTable.take(self.commands(), arrays["command"]),
+                "tid": arrays["tid"],
+                "cpu": arrays["cpu"],
+                "event": StackTable.take(self.events(), arrays["event"]),
+                "stack_id": arrays["stack_id"],
+            }
+        )
+
+
+if __name__ == "__main__":
+    from timing import DataPreparation
+
+    parser = argparse.ArgumentParser(description="TCSA trace file tools.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert_parser = subparsers.add_parser(
+        "convert", help="Convert perf script text into a TCSA trace file."
+    )
+    convert_parser.add_argument("file_path")
+    convert_parser.add_argument("output_path")
+    convert_parser.add_argument("--jobs", type=int, default=-1)
+    args = parser.parse_args()
+
+    data_preparation = DataPreparation()
+    perf_records_df = data_preparation.data_loading_parallel(
+        args.file_path, n_jobs=args.jobs
+    )
+    write_trace(args.output_path, data_preparation.stack_table, perf_records_df)
+    print(
+        f"{args.output_path}: {len(perf_records_df)} samples, "
+        f"{len(data_preparation.stack_table)} call stacks, "
+        f"{len(data_preparation.stack_table.frames)} frames"
+    )